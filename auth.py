@@ -1,35 +1,158 @@
 import json
-from google.oauth2 import service_account
-import boto3
-from azure.identity import ClientSecretCredential
-from azure.mgmt.compute import ComputeManagementClient
-from config import AWS_CREDS_PATH, GCP_CREDS_PATH, AZURE_CREDS_PATH
+import threading
+from functools import lru_cache
+from config import AWS_CREDS_PATH, GCP_CREDS_PATH, AZURE_CREDS_PATH, CLIENT_POOL_SIZE
 
+@lru_cache(maxsize=None)
 def load_credentials(creds_path):
     with open(creds_path, 'r') as f:
         return json.load(f)
 
-def get_aws_client(service):
-    creds = load_credentials(AWS_CREDS_PATH)
-    return boto3.client(
-        service,
-        aws_access_key_id=creds['AWS_ACCESS_KEY_ID'],
-        aws_secret_access_key=creds['AWS_SECRET_ACCESS_KEY'],
-        region_name=creds['AWS_DEFAULT_REGION']
-    )
-
-def get_gcp_client():
-    credentials = service_account.Credentials.from_service_account_file(GCP_CREDS_PATH)
-    from google.cloud import compute_v1
-    return compute_v1.InstancesClient(credentials=credentials)
-
-def get_azure_client():
-    creds = load_credentials(AZURE_CREDS_PATH)
-    credential = ClientSecretCredential(
-        tenant_id=creds['TENANT_ID'],
-        client_id=creds['CLIENT_ID'],
-        client_secret=creds['CLIENT_SECRET'],
-    )
-    subscription_id = creds['SUBSCRIPTION_ID']
-  # Read subscription ID from credentials
-    return ComputeManagementClient(credential, subscription_id)
+@lru_cache(maxsize=None)
+def load_gcp_credentials(creds_path):
+    from google.oauth2 import service_account
+    return service_account.Credentials.from_service_account_file(creds_path)
+
+DEFAULT_ACCOUNTS = {
+    'aws': AWS_CREDS_PATH,
+    'gcp': GCP_CREDS_PATH,
+    'azure': AZURE_CREDS_PATH,
+}
+
+class ClientRegistry:
+    """Process-wide registry of SDK clients.
+
+    Clients are created lazily on first use and shared afterwards. They are keyed
+    by (provider, service, region, account), where account is the path of the
+    credentials file (the configured default when None). Azure management clients
+    are global, so for them region holds the subscription ID instead (the one in
+    the credentials file when None). Credential files are read once per path and
+    HTTP connection pools are sized to pool_size. Each provider's SDK is imported
+    only when its first client is created.
+    """
+
+    def __init__(self, pool_size=CLIENT_POOL_SIZE):
+        self.pool_size = pool_size
+        self._clients = {}
+        self._lock = threading.RLock()
+
+    def get(self, provider, service, region=None, account=None):
+        account = account or DEFAULT_ACCOUNTS.get(provider)
+        key = (provider, service, region, account)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._create(provider, service, region, account)
+                self._clients[key] = client
+            return client
+
+    def register(self, provider, service, client, region=None, account=None):
+        """Use an already constructed client for the given key."""
+        with self._lock:
+            self._clients[(provider, service, region, account or DEFAULT_ACCOUNTS.get(provider))] = client
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+    def _create(self, provider, service, region, account):
+        if provider == 'aws':
+            return self._create_aws(service, region, account)
+        if provider == 'gcp':
+            return self._create_gcp(service, account)
+        if provider == 'azure':
+            return self._create_azure(service, region, account)
+        raise ValueError(f"Unknown provider: {provider}")
+
+    def _create_aws(self, service, region, creds_path):
+        import boto3
+        from botocore.config import Config as BotoConfig
+
+        creds = load_credentials(creds_path)
+        # boto3 sessions are not thread-safe, so each client gets its own
+        session = boto3.session.Session(
+            aws_access_key_id=creds['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=creds['AWS_SECRET_ACCESS_KEY'],
+        )
+        return session.client(
+            service,
+            region_name=region or creds['AWS_DEFAULT_REGION'],
+            # Throttled calls are retried by ratelimit.call_api, whose limiter has to see them
+            config=BotoConfig(max_pool_connections=self.pool_size, retries={'total_max_attempts': 1}),
+        )
+
+    def _create_gcp(self, service, creds_path):
+        credentials = load_gcp_credentials(creds_path)
+        if service == 'compute':
+            from google.cloud import compute_v1
+            return compute_v1.InstancesClient(credentials=credentials)
+        if service == 'zone_operations':
+            from google.cloud import compute_v1
+            return compute_v1.ZoneOperationsClient(credentials=credentials)
+        if service == 'monitoring':
+            from google.cloud import monitoring_v3
+            return monitoring_v3.MetricServiceClient(credentials=credentials)
+        raise ValueError(f"Unknown GCP service: {service}")
+
+    def _create_azure(self, service, region, creds_path):
+        creds = load_credentials(creds_path)
+        if service == 'credential':
+            from azure.identity import ClientSecretCredential
+            return ClientSecretCredential(
+                tenant_id=creds['TENANT_ID'],
+                client_id=creds['CLIENT_ID'],
+                client_secret=creds['CLIENT_SECRET'],
+            )
+        # All clients of an account share one credential, and therefore one token cache
+        credential = self.get('azure', 'credential', account=creds_path)
+        subscription_id = region or creds['SUBSCRIPTION_ID']
+        if service == 'compute':
+            from azure.mgmt.compute import ComputeManagementClient
+            return ComputeManagementClient(credential, subscription_id, **self._azure_options())
+        if service == 'monitor':
+            from azure.mgmt.monitor import MonitorManagementClient
+            return MonitorManagementClient(credential, subscription_id, **self._azure_options())
+        if service == 'resourcegraph':
+            from azure.mgmt.resourcegraph import ResourceGraphClient
+            return ResourceGraphClient(credential, **self._azure_options())
+        if service == 'metrics':
+            from azure.monitor.query import MetricsClient
+            return MetricsClient(f"https://{region}.metrics.monitor.azure.com", credential,
+                                 **self._azure_options())
+        raise ValueError(f"Unknown Azure service: {service}")
+
+    def _azure_options(self):
+        import requests
+        from azure.core.pipeline.transport import RequestsTransport
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        # Throttled calls are retried by ratelimit.call_api, whose limiter has to see them
+        return {'transport': RequestsTransport(session=session, session_owner=True), 'retry_total': 0}
+
+registry = ClientRegistry()
+
+def get_aws_client(service, region=None, account=None):
+    return registry.get('aws', service, region, account)
+
+def get_gcp_client(account=None):
+    return registry.get('gcp', 'compute', account=account)
+
+def get_gcp_zone_operations_client(account=None):
+    return registry.get('gcp', 'zone_operations', account=account)
+
+def get_gcp_monitoring_client(account=None):
+    return registry.get('gcp', 'monitoring', account=account)
+
+def get_azure_client(account=None, subscription_id=None):
+    return registry.get('azure', 'compute', subscription_id, account)
+
+def get_azure_monitor_client(account=None, subscription_id=None):
+    return registry.get('azure', 'monitor', subscription_id, account)
+
+def get_azure_metrics_client(location, account=None):
+    return registry.get('azure', 'metrics', location, account)
+
+def get_azure_resource_graph_client(account=None):
+    return registry.get('azure', 'resourcegraph', account=account)
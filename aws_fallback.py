@@ -1,65 +1,161 @@
 from datetime import datetime, timedelta
-from utils import check_required_tags
-from config import AWS_CPU_THRESHOLD, VM_AGE_DAYS, CPU_CHECK_DAYS
+from utils import check_required_tags, tags_match, bounded_map
+from ratelimit import call_api
+from records import VMRecord
+from inventory import describe_vm
+from telemetry import telemetry
+from config import AWS_CPU_THRESHOLD, VM_AGE_DAYS, CPU_CHECK_DAYS, METRICS_BUCKET_SECONDS
 import logging
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def get_instance_creation_time(ec2_client, instance_id):
+# GetMetricData accepts at most 500 metric queries per request
+METRIC_DATA_BATCH_SIZE = 500
+
+def get_instance_creation_time(ec2_client, instance):
     try:
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        launch_time = response['Reservations'][0]['Instances'][0]['LaunchTime']
-        return launch_time
+        return describe_vm(ec2_client, instance).created
     except Exception as e:
-        logger.error(f"Error while fetching creation time for instance {instance_id}: {e}")
+        logger.error(f"Error while fetching creation time for instance {instance.id}: {e}")
         return None
 
+def is_aws_candidate(instance, ec2_client):
+    """Check the required tags, the running state and the minimum age of an instance.
+
+    The tags, state and launch time of the VMRecord are used when the listing
+    filled them in; otherwise the instance is described.
+    """
+    instance_id = instance.id
+    with telemetry.span("aws", "tags"):
+        if instance.tags is not None:
+            has_tags = tags_match(instance.tags)
+        else:
+            has_tags = check_required_tags(ec2_client, instance)
+    if not has_tags:
+        logger.debug(f"Instance {instance_id} does not have required tags.")
+        return False
+
+    if instance.state != 'running':
+        logger.debug(f"Instance {instance_id} is {instance.state}.")
+        return False
+
+    # Check instance age
+    with telemetry.span("aws", "age"):
+        creation_time = instance.created or get_instance_creation_time(ec2_client, instance)
+    if not creation_time:
+        logger.error(f"Could not determine creation time for instance {instance_id}")
+        return False
+
+    instance_age = datetime.now(creation_time.tzinfo) - creation_time
+    if instance_age.days < VM_AGE_DAYS:
+        logger.debug(f"Instance {instance_id} is {instance_age.days} days old.")
+        logger.debug(f"Instance {instance_id} is less than {VM_AGE_DAYS} days old. Skipping.")
+        return False
+
+    logger.debug(f"Instance {instance_id} is {instance_age.days} days old. Checking CPU utilization.")
+    return True
+
+def get_cpu_series_aws(cloudwatch_client, instance_ids, max_workers=1, start=None, end=None):
+    """Return the 5-minute CPUUtilization maxima of each instance between start and end.
+
+    The range defaults to the last CPU_CHECK_DAYS. Instances are packed into
+    GetMetricData requests of up to METRIC_DATA_BATCH_SIZE queries and every page of
+    each request is followed. Up to max_workers requests run concurrently.
+    """
+    points = _get_metric_data(cloudwatch_client, instance_ids, max_workers, start, end, 300)
+    return {instance_id: values for instance_id, (_, values) in points.items()}
+
+def get_cpu_maxima_aws(cloudwatch_client, instance_ids, max_workers=1, start=None, end=None):
+    """Return the maximum CPUUtilization of each instance between start and end.
+
+    Instances without any datapoint map to None. The maximum of the hourly
+    maxima is the same as that of the 5-minute ones, from a twelfth of the
+    datapoints. See get_cpu_series_aws.
+    """
+    points = _get_metric_data(cloudwatch_client, instance_ids, max_workers, start, end, METRICS_BUCKET_SECONDS)
+    return {instance_id: max(values) if values else None for instance_id, (_, values) in points.items()}
+
+def get_cpu_buckets_aws(cloudwatch_client, instance_ids, max_workers=1, start=None, end=None):
+    """Return (period start, maximum) of each METRICS_BUCKET_SECONDS period per instance.
+
+    Period starts are epoch seconds. See get_cpu_series_aws.
+    """
+    points = _get_metric_data(cloudwatch_client, instance_ids, max_workers, start, end, METRICS_BUCKET_SECONDS)
+    return {instance_id: [(timestamp.timestamp(), value) for timestamp, value in zip(timestamps, values)]
+            for instance_id, (timestamps, values) in points.items()}
+
+def _get_metric_data(cloudwatch_client, instance_ids, max_workers, start, end, period):
+    """Return ([timestamps], [values]) of each instance, at period seconds granularity."""
+    instance_ids = list(instance_ids)
+    now = end or datetime.utcnow()
+    start = start or now - timedelta(days=CPU_CHECK_DAYS)
+
+    batches = [instance_ids[offset:offset + METRIC_DATA_BATCH_SIZE]
+               for offset in range(0, len(instance_ids), METRIC_DATA_BATCH_SIZE)]
+    points = {}
+    for batch_points in bounded_map(lambda batch: _get_metric_data_batch(cloudwatch_client, batch, start, now, period),
+                                    batches, max_workers):
+        points.update(batch_points)
+    return points
+
+def _get_metric_data_batch(cloudwatch_client, batch, start, end, period):
+    logger.info(f"Fetching metrics from {start} to {end} for {len(batch)} AWS instances")
+    points = {instance_id: ([], []) for instance_id in batch}
+    request = {
+        'MetricDataQueries': [
+            {
+                # Query ids must start with a lowercase letter
+                'Id': f"cpu{index}",
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/EC2',
+                        'MetricName': 'CPUUtilization',
+                        'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}],
+                    },
+                    'Period': period,
+                    'Stat': 'Maximum',
+                },
+                'ReturnData': True,
+            }
+            for index, instance_id in enumerate(batch)
+        ],
+        'StartTime': start,
+        'EndTime': end,
+    }
+
+    while True:
+        response = call_api('aws', 'metrics', cloudwatch_client.get_metric_data, **request)
+        for result in response.get('MetricDataResults', []):
+            instance_id = batch[int(result['Id'][len("cpu"):])]
+            timestamps, values = points[instance_id]
+            timestamps.extend(result.get('Timestamps', []))
+            values.extend(result.get('Values', []))
+        next_token = response.get('NextToken')
+        if not next_token:
+            break
+        request['NextToken'] = next_token
+
+    return points
+
+def is_low_cpu_aws(instance_id, cpu_max):
+    """Apply AWS_CPU_THRESHOLD to the maximum CPU utilization of an instance."""
+    if cpu_max is not None and cpu_max > AWS_CPU_THRESHOLD:
+        logger.debug(f"Instance {instance_id} exceeds CPU threshold with usage: {cpu_max}")
+        return False
+
+    logger.debug(f"Instance {instance_id} has low CPU usage for the last {CPU_CHECK_DAYS} days.")
+    return True
+
 def has_low_usage_aws(instance_id, ec2_client, cloudwatch_client):
     logger.info(f"Checking low usage for AWS instance: {instance_id}")
     try:
-        if not check_required_tags(ec2_client, instance_id):
-            logger.warning(f"Instance {instance_id} does not have required tags.")
-            return False
-
-        # Check instance age
-        creation_time = get_instance_creation_time(ec2_client, instance_id)
-        if not creation_time:
-            logger.error(f"Could not determine creation time for instance {instance_id}")
+        if not is_aws_candidate(VMRecord('aws', instance_id), ec2_client):
             return False
 
-        instance_age = datetime.now(creation_time.tzinfo) - creation_time
-        if instance_age.days < VM_AGE_DAYS:
-            logger.info(f"Instance {instance_id} is {instance_age.days} days old.")
-            logger.info(f"Instance {instance_id} is less than {VM_AGE_DAYS} days old. Skipping.")
-            return False
-
-        logger.info(f"Instance {instance_id} is {instance_age.days} days old. Checking CPU utilization.")
-
         # Get CPU metrics for the last 2 days
-        now = datetime.utcnow()
-        start = now - timedelta(days=CPU_CHECK_DAYS)
-        logger.info(f"Fetching metrics from {start} to {now} for instance: {instance_id}")
-
-        response = cloudwatch_client.get_metric_statistics(
-            Namespace='AWS/EC2',
-            MetricName='CPUUtilization',
-            Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-            StartTime=start,
-            EndTime=now,
-            Period=300,  # 5-minute granularity
-            Statistics=['Maximum']
-        )
-
-        # Check if any data point exceeds the threshold
-        for dp in response.get('Datapoints', []):
-            logger.info(f"CPU utilization data point: {dp['Maximum']}")
-            if dp['Maximum'] > AWS_CPU_THRESHOLD:
-                logger.warning(f"Instance {instance_id} exceeds CPU threshold with usage: {dp['Maximum']}")
-                return False
-
-        logger.info(f"Instance {instance_id} has low CPU usage for the last {CPU_CHECK_DAYS} days.")
-        return True
+        maxima = get_cpu_maxima_aws(cloudwatch_client, [instance_id])
+        return is_low_cpu_aws(instance_id, maxima[instance_id])
 
     except Exception as e:
         logger.error(f"Error in has_low_usage_aws: {e}")
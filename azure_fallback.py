@@ -1,80 +1,177 @@
 from datetime import datetime, timedelta
-from azure.mgmt.monitor import MonitorManagementClient
-from azure.identity import ClientSecretCredential
-from utils import check_required_tags
-from config import AZURE_CPU_THRESHOLD, VM_AGE_DAYS, CPU_CHECK_DAYS
+from auth import get_azure_monitor_client, get_azure_metrics_client
+from utils import check_required_tags, tags_match, bounded_map
+from ratelimit import call_api
+from records import VMRecord
+from inventory import describe_vm
+from telemetry import telemetry
+from config import AZURE_CPU_THRESHOLD, VM_AGE_DAYS, CPU_CHECK_DAYS, METRICS_BUCKET_SECONDS
 import logging
-from azure.mgmt.compute import ComputeManagementClient
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def get_vm_creation_time(compute_client, resource_group, vm_name):
+# The metrics batch API accepts at most 50 resource IDs per request
+METRICS_BATCH_SIZE = 50
+
+def get_vm_creation_time(compute_client, vm):
     try:
-        vm = compute_client.virtual_machines.get(resource_group, vm_name)
-        return vm.time_created
+        return describe_vm(compute_client, vm).created
     except Exception as e:
-        logger.error(f"Error while fetching creation time for VM {vm_name}: {e}")
+        logger.error(f"Error while fetching creation time for VM {vm.name}: {e}")
         return None
 
-def has_low_usage_azure(vm_resource_id, compute_client, azure_creds):
-    logger.info(f"Checking low usage for VM: {vm_resource_id}")
-    try:
-        parts = vm_resource_id.split('/')
-        resource_group = parts[4]
-        vm_name = parts[8]
-        logger.info(f"Extracted resource group: {resource_group}, VM name: {vm_name}")
+def is_azure_candidate(vm, compute_client):
+    """Check the required tags, the power state and the minimum age of a VM.
 
-        if not check_required_tags(compute_client, vm_resource_id):
-            logger.warning(f"VM {vm_resource_id} does not have required tags.")
-            return False
+    The tags, power state and creation time of the VMRecord are used when the
+    listing filled them in; otherwise the VM is fetched.
+    """
+    vm_resource_id = vm.id
+    vm_name = vm.name
 
-        # Check VM age
-        creation_time = get_vm_creation_time(compute_client, resource_group, vm_name)
-        if not creation_time:
-            logger.error(f"Could not determine creation time for VM {vm_name}")
-            return False
+    with telemetry.span("azure", "tags"):
+        if vm.tags is not None:
+            has_tags = tags_match(vm.tags)
+        else:
+            has_tags = check_required_tags(compute_client, vm)
+    if not has_tags:
+        logger.debug(f"VM {vm_resource_id} does not have required tags.")
+        return False
 
-        instance_age = datetime.now(creation_time.tzinfo) - creation_time
-        if instance_age.days < VM_AGE_DAYS:
-            logger.info(f"VM {vm_name} is {instance_age.days} days old.")
-            logger.info(f"VM {vm_name} is less than {VM_AGE_DAYS} days old. Skipping.")
-            return False
+    # Power state codes are compared case-insensitively, as Resource Graph does
+    if (vm.state or '').lower() != 'powerstate/running':
+        logger.debug(f"VM {vm_resource_id} is in power state {vm.state}.")
+        return False
+
+    # Check VM age
+    with telemetry.span("azure", "age"):
+        creation_time = vm.created or get_vm_creation_time(compute_client, vm)
+    if not creation_time:
+        logger.error(f"Could not determine creation time for VM {vm_name}")
+        return False
+
+    instance_age = datetime.now(creation_time.tzinfo) - creation_time
+    if instance_age.days < VM_AGE_DAYS:
+        logger.debug(f"VM {vm_name} is {instance_age.days} days old.")
+        logger.debug(f"VM {vm_name} is less than {VM_AGE_DAYS} days old. Skipping.")
+        return False
+
+    logger.debug(f"VM {vm_name} is {instance_age.days} days old. Checking CPU utilization.")
+    return True
+
+def get_cpu_max_azure(monitor_client, vm_resource_id):
+    """Return the maximum 'Percentage CPU' of a single VM over the last CPU_CHECK_DAYS."""
+    now = datetime.utcnow()
+    start = now - timedelta(days=CPU_CHECK_DAYS)
+    logger.debug(f"Fetching metrics from {start} to {now} for VM: {vm_resource_id}")
+
+    metrics_data = call_api(
+        'azure', 'metrics', monitor_client.metrics.list,
+        resource_uri=vm_resource_id,
+        timespan=f"{start}/{now}",
+        interval='PT5M',  # 5-minute granularity
+        metricnames='Percentage CPU',
+        aggregation='Maximum'
+    )
+    logger.debug("Metrics data retrieved successfully.")
+    return _max_of_metrics(metrics_data.value)
+
+def get_cpu_series_azure(vms, account=None, max_workers=1, start=None, end=None):
+    """Return the 5-minute 'Percentage CPU' maxima of each VM between start and end.
+
+    The range defaults to the last CPU_CHECK_DAYS. vms are VMRecords from the
+    inventory. The metrics batch API only accepts resources of one subscription and
+    region per request, so VMs are grouped by both and sent in chunks of
+    METRICS_BATCH_SIZE resource IDs, up to max_workers at a time.
+    """
+    return _query_resources(vms, account, max_workers, start, end, timedelta(minutes=5), _series_of_metrics)
+
+def get_cpu_maxima_azure(vms, account=None, max_workers=1, start=None, end=None):
+    """Return the maximum 'Percentage CPU' of each VM between start and end.
+
+    VMs without data map to None. The maximum of the hourly maxima is the same
+    as that of the 5-minute ones, from a twelfth of the datapoints. See
+    get_cpu_series_azure.
+    """
+    series = _query_resources(vms, account, max_workers, start, end, timedelta(seconds=METRICS_BUCKET_SECONDS),
+                              _series_of_metrics)
+    return {vm_id: max(values) if values else None for vm_id, values in series.items()}
 
-        logger.info(f"VM {vm_name} is {instance_age.days} days old. Checking CPU utilization.")
+def get_cpu_buckets_azure(vms, account=None, max_workers=1, start=None, end=None):
+    """Return (period start, maximum) of each METRICS_BUCKET_SECONDS period per VM.
+
+    Period starts are epoch seconds. See get_cpu_series_azure.
+    """
+    return _query_resources(vms, account, max_workers, start, end, timedelta(seconds=METRICS_BUCKET_SECONDS),
+                            _points_of_metrics)
+
+def _query_resources(vms, account, max_workers, start, end, granularity, extract):
+    """Return extract(metrics) of each VM, queried at granularity."""
+    groups = {}
+    for vm in vms:
+        groups.setdefault((vm.project, vm.location), []).append(vm.id)
+
+    batches = []
+    for (subscription_id, location), resource_ids in groups.items():
+        for offset in range(0, len(resource_ids), METRICS_BATCH_SIZE):
+            batches.append((location, resource_ids[offset:offset + METRICS_BATCH_SIZE]))
+
+    values = {}
+    timespan = (start, end) if start and end else timedelta(days=CPU_CHECK_DAYS)
+    for batch_values in bounded_map(
+            lambda batch: _query_resources_batch(*batch, account, timespan, granularity, extract),
+            batches, max_workers):
+        values.update(batch_values)
+    return {vm.id: values.get(vm.id, []) for vm in vms}
+
+def _query_resources_batch(location, batch, account, timespan, granularity, extract):
+    logger.info(f"Fetching metrics for {len(batch)} Azure VMs in {location}")
+    results = call_api(
+        'azure', 'metrics', get_azure_metrics_client(location, account).query_resources,
+        resource_ids=batch,
+        metric_namespace='Microsoft.Compute/virtualMachines',
+        metric_names=['Percentage CPU'],
+        timespan=timespan,
+        granularity=granularity,
+        aggregations=['Maximum'],
+    )
+    # Results are not guaranteed to follow the request order, and resource IDs are case-insensitive
+    values = {result.resource_id.lower(): extract(result.metrics) for result in results}
+    return {vm_resource_id: values.get(vm_resource_id.lower(), []) for vm_resource_id in batch}
+
+def _series_of_metrics(metrics):
+    return [data.maximum for item in metrics for timeseries in item.timeseries
+            for data in timeseries.data if data.maximum is not None]
+
+def _points_of_metrics(metrics):
+    return [(data.timestamp.timestamp(), data.maximum) for item in metrics for timeseries in item.timeseries
+            for data in timeseries.data if data.maximum is not None]
+
+def _max_of_metrics(metrics):
+    values = _series_of_metrics(metrics)
+    return max(values) if values else None
+
+def is_low_cpu_azure(vm_resource_id, cpu_max):
+    """Apply AZURE_CPU_THRESHOLD to the maximum CPU utilization of a VM."""
+    if cpu_max is not None and cpu_max > AZURE_CPU_THRESHOLD:
+        logger.debug(f"VM {vm_resource_id} exceeds CPU threshold with usage: {cpu_max}")
+        return False
+
+    logger.debug(f"VM {vm_resource_id} has low CPU usage for the last {CPU_CHECK_DAYS} days.")
+    return True
+
+def has_low_usage_azure(vm_resource_id, compute_client, azure_creds, vm=None, monitor_client=None):
+    logger.info(f"Checking low usage for VM: {vm_resource_id}")
+    try:
+        if not is_azure_candidate(vm or VMRecord.from_azure_id(vm_resource_id), compute_client):
+            return False
 
         # Get CPU metrics for the last 2 days
-        creds = ClientSecretCredential(
-            tenant_id=azure_creds['tenant_id'],
-            client_id=azure_creds['client_id'],
-            client_secret=azure_creds['client_secret'],
-        )
-        monitor_client = MonitorManagementClient(creds, azure_creds['subscription_id'])
-
-        now = datetime.utcnow()
-        start = now - timedelta(days=CPU_CHECK_DAYS)
-        logger.info(f"Fetching metrics from {start} to {now} for VM: {vm_resource_id}")
-
-        metrics_data = monitor_client.metrics.list(
-            resource_uri=vm_resource_id,
-            timespan=f"{start}/{now}",
-            interval='PT5M',  # 5-minute granularity
-            metricnames='Percentage CPU',
-            aggregation='Maximum'
-        )
-        logger.info("Metrics data retrieved successfully.")
-
-        for item in metrics_data.value:
-            for timeseries in item.timeseries:
-                for data in timeseries.data:
-                    if data.maximum:
-                        logger.info(f"CPU usage data point: {data.maximum}")
-                    if data.maximum and data.maximum > AZURE_CPU_THRESHOLD:
-                        logger.warning(f"VM {vm_resource_id} exceeds CPU threshold with usage: {data.maximum}")
-                        return False
-
-        logger.info(f"VM {vm_resource_id} has low CPU usage for the last {CPU_CHECK_DAYS} days.")
-        return True
+        if monitor_client is None:
+            monitor_client = get_azure_monitor_client()
+        cpu_max = get_cpu_max_azure(monitor_client, vm_resource_id)
+        return is_low_cpu_azure(vm_resource_id, cpu_max)
 
     except Exception as e:
         logger.error(f"Error in has_low_usage_azure: {e}")
@@ -0,0 +1,410 @@
+import re
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from config import REQUIRED_TAGS, VM_AGE_DAYS, CPU_CHECK_DAYS
+
+# Local stand-ins for the parts of the EC2, CloudWatch, GCP compute/monitoring and
+# Azure compute/Resource Graph/metrics clients that FallbackController uses. They
+# serve a synthetic fleet, sleep `latency` seconds per call, reject a `throttle_rate`
+# share of calls the way each provider does, and page list results `page_size` at a
+# time. Every call is counted per (provider, endpoint).
+
+class FakeAwsThrottle(Exception):
+    """Shaped like botocore's ClientError for a throttled request."""
+
+    def __init__(self, endpoint):
+        super().__init__(f"Rate exceeded calling {endpoint}")
+        self.response = {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}, 'ResponseMetadata': {}}
+
+class FakeGcpThrottle(Exception):
+    """Shaped like google.api_core's TooManyRequests."""
+    code = 429
+
+class FakeAzureThrottle(Exception):
+    """Shaped like azure.core's HttpResponseError for a 429 response."""
+    status_code = 429
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"Too many requests calling {endpoint}")
+        self.response = SimpleNamespace(headers={'Retry-After': str(retry_after)})
+
+THROTTLE_ERRORS = {
+    'aws': lambda endpoint, cloud: FakeAwsThrottle(endpoint),
+    'gcp': lambda endpoint, cloud: FakeGcpThrottle(f"Quota exceeded calling {endpoint}"),
+    'azure': lambda endpoint, cloud: FakeAzureThrottle(endpoint, cloud.retry_after),
+}
+
+class FakeCloud:
+    """Call accounting, latency and throttling shared by all fake clients of one benchmark run."""
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, page_size=1000, delete_seconds=0.0, retry_after=0,
+                 seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.page_size = page_size
+        self.delete_seconds = delete_seconds
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.throttled = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, provider, endpoint):
+        with self._lock:
+            self.calls[(provider, endpoint)] += 1
+            throttled = self.throttle_rate and self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttled[(provider, endpoint)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise THROTTLE_ERRORS[provider](endpoint, self)
+
+class FakeVM:
+    """One synthetic VM, in provider-neutral form."""
+    __slots__ = ('index', 'tagged', 'created', 'peak', 'running', 'deleted')
+
+    def __init__(self, index, tagged, created, peak):
+        self.index = index
+        self.tagged = tagged
+        self.created = created
+        self.peak = peak
+        self.running = True
+        self.deleted = False
+
+    @property
+    def tags(self):
+        return dict(REQUIRED_TAGS) if self.tagged else {'team': 'other'}
+
+def make_fleet(size, seed=0, tagged_share=0.7, old_share=0.8, idle_share=0.5):
+    """Return size FakeVMs; the shares say how many carry the tags, are old enough and are idle."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    fleet = []
+    for index in range(size):
+        age_days = rng.uniform(VM_AGE_DAYS + 1, VM_AGE_DAYS * 4) if rng.random() < old_share else rng.uniform(0, VM_AGE_DAYS - 1)
+        peak = rng.uniform(0.1, 3.0) if rng.random() < idle_share else rng.uniform(20.0, 95.0)
+        fleet.append(FakeVM(index, rng.random() < tagged_share, now - timedelta(days=age_days), peak))
+    return fleet
+
+def is_prefiltered(vm, check_age=False):
+    """The predicates the controller pushes server-side when SERVER_SIDE_PREFILTER is on."""
+    if not (vm.tagged and vm.running and not vm.deleted):
+        return False
+    return not check_age or vm.created <= datetime.now(timezone.utc) - timedelta(days=VM_AGE_DAYS)
+
+def cpu_samples(vm, start, end, period=300):
+    """Percent CPU per period of seconds between two datetimes, peaking at vm.peak once."""
+    count = max(int((end - start).total_seconds() // period), 1)
+    samples = [vm.peak * 0.5] * count
+    samples[vm.index % count] = vm.peak
+    return samples
+
+def period_starts(start, end, period=300):
+    """The start of every period counted by cpu_samples."""
+    count = max(int((end - start).total_seconds() // period), 1)
+    return [start + timedelta(seconds=period * index) for index in range(count)]
+
+def _window(start, end):
+    end = end or datetime.now(timezone.utc)
+    return start or end - timedelta(days=CPU_CHECK_DAYS), end
+
+def _interval_bounds(interval):
+    """(start, end) of a monitoring_v3.TimeInterval or of the equivalent dict."""
+    if isinstance(interval, dict):
+        return tuple(datetime.fromtimestamp(interval[key]['seconds'], timezone.utc)
+                     for key in ('start_time', 'end_time'))
+    # proto-plus exposes Timestamp fields as datetimes
+    return interval.start_time, interval.end_time
+
+# AWS
+
+class FakeEC2:
+    def __init__(self, cloud, fleet, region, regions):
+        self.cloud = cloud
+        self.region = region
+        self.regions = regions
+        self.instances = {f"i-{region}-{vm.index:08x}": vm for vm in fleet}
+        self._filtered = {}
+
+    def describe_regions(self, Filters=None):
+        self.cloud.call('aws', 'describe_regions')
+        return {'Regions': [{'RegionName': region} for region in self.regions]}
+
+    def describe_instances(self, Filters=None, InstanceIds=None, NextToken=None):
+        self.cloud.call('aws', 'describe_instances')
+        if InstanceIds is not None:
+            matches = [instance_id for instance_id in InstanceIds if instance_id in self.instances]
+        else:
+            matches = self._matching(Filters or [])
+        offset = int(NextToken or 0)
+        page = matches[offset:offset + self.cloud.page_size]
+        response = {'Reservations': [{'Instances': [self._describe(instance_id) for instance_id in page]}]}
+        if offset + self.cloud.page_size < len(matches):
+            response['NextToken'] = str(offset + self.cloud.page_size)
+        return response
+
+    def _matching(self, filters):
+        # The same listing is paged many times, so filter once per filter set
+        key = repr(filters)
+        if key not in self._filtered:
+            prefilter = any(f['Name'] == 'instance-state-name' for f in filters)
+            self._filtered[key] = [instance_id for instance_id, vm in self.instances.items()
+                                   if not vm.deleted and (not prefilter or is_prefiltered(vm))]
+        return self._filtered[key]
+
+    def _describe(self, instance_id):
+        vm = self.instances[instance_id]
+        return {
+            'InstanceId': instance_id,
+            'Placement': {'AvailabilityZone': f"{self.region}a"},
+            'Tags': [{'Key': key, 'Value': value} for key, value in vm.tags.items()],
+            'LaunchTime': vm.created,
+            'State': {'Name': 'running' if vm.running else 'terminated'},
+        }
+
+    def terminate_instances(self, InstanceIds):
+        self.cloud.call('aws', 'terminate_instances')
+        for instance_id in InstanceIds:
+            self.instances[instance_id].deleted = True
+        return {'TerminatingInstances': [{'InstanceId': instance_id} for instance_id in InstanceIds]}
+
+class FakeCloudWatch:
+    # GetMetricData returns at most this many datapoints per call
+    MAX_DATAPOINTS = 100800
+
+    def __init__(self, cloud, ec2):
+        self.cloud = cloud
+        self.ec2 = ec2
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, NextToken=None):
+        self.cloud.call('aws', 'get_metric_data')
+        start, end = _window(StartTime, EndTime)
+        offset = int(NextToken or 0)
+        results = []
+        datapoints = 0
+        timestamps = {}
+        for query in MetricDataQueries[offset:]:
+            if results and datapoints >= self.MAX_DATAPOINTS:
+                break
+            period = query['MetricStat']['Period']
+            if period not in timestamps:
+                timestamps[period] = period_starts(start, end, period)
+            vm = self.ec2.instances[query['MetricStat']['Metric']['Dimensions'][0]['Value']]
+            values = cpu_samples(vm, start, end, period)
+            datapoints += len(values)
+            results.append({'Id': query['Id'], 'Timestamps': timestamps[period], 'Values': values})
+        response = {'MetricDataResults': results}
+        if offset + len(results) < len(MetricDataQueries):
+            response['NextToken'] = str(offset + len(results))
+        return response
+
+# GCP
+
+class _Pager:
+    """The part of a google.api_core pager the tool uses: the already fetched first page."""
+
+    def __init__(self, page):
+        self.pages = iter([page])
+
+class FakeGcpOperation:
+    def __init__(self, cloud, name):
+        self.cloud = cloud
+        self.name = name
+        self._done_at = time.monotonic() + cloud.delete_seconds
+
+    def done(self):
+        self.cloud.call('gcp', 'operations.get')
+        return time.monotonic() >= self._done_at
+
+    def result(self):
+        return None
+
+class FakeGcpCompute:
+    def __init__(self, cloud, fleet, zones):
+        self.cloud = cloud
+        self.zones = zones
+        self.instances = {str(1000000000 + vm.index): vm for vm in fleet}
+        self._filtered = {}
+
+    def _zone(self, vm):
+        return self.zones[vm.index % len(self.zones)]
+
+    def aggregated_list(self, request):
+        self.cloud.call('gcp', 'aggregated_list')
+        key = request.get('filter')
+        if key not in self._filtered:
+            self._filtered[key] = [instance_id for instance_id, vm in self.instances.items()
+                                   if not vm.deleted and (not key or is_prefiltered(vm))]
+        matches = self._filtered[key]
+        offset = int(request.get('page_token') or 0)
+        items = {}
+        for instance_id in matches[offset:offset + self.cloud.page_size]:
+            vm = self.instances[instance_id]
+            items.setdefault(f"zones/{self._zone(vm)}", SimpleNamespace(instances=[])).instances.append(
+                SimpleNamespace(id=int(instance_id), name=f"vm-{vm.index}", labels=vm.tags,
+                                creation_timestamp=vm.created.isoformat(),
+                                status='RUNNING' if vm.running else 'TERMINATED'))
+        more = offset + self.cloud.page_size < len(matches)
+        return _Pager(SimpleNamespace(items=items, next_page_token=str(offset + self.cloud.page_size) if more else ""))
+
+    def delete(self, project, zone, instance):
+        self.cloud.call('gcp', 'delete')
+        self.instances[str(1000000000 + int(instance.split('-')[1]))].deleted = True
+        return FakeGcpOperation(self.cloud, f"operation-delete-{instance}")
+
+class FakeGcpMonitoring:
+    def __init__(self, cloud, compute):
+        self.cloud = cloud
+        self.compute = compute
+
+    def list_time_series(self, request):
+        self.cloud.call('gcp', 'list_time_series')
+        match = re.search(r'one_of\(([^)]*)\)', request['filter'])
+        if match:
+            instance_ids = re.findall(r'"([^"]+)"', match.group(1))
+        else:
+            instance_ids = list(self.compute.instances)
+        start, end = _interval_bounds(request['interval'])
+        period = request['aggregation']['alignment_period']['seconds']
+        aligned = period < (end - start).total_seconds()
+        # Points are stamped with the end of their alignment period
+        if aligned:
+            intervals = [SimpleNamespace(end_time=period_start + timedelta(seconds=period))
+                         for period_start in period_starts(start, end, period)]
+        else:
+            intervals = [SimpleNamespace(end_time=end)]
+
+        offset = int(request.get('page_token') or 0)
+        series = []
+        for instance_id in instance_ids[offset:offset + self.cloud.page_size]:
+            vm = self.compute.instances.get(instance_id)
+            if vm is None:
+                continue
+            values = cpu_samples(vm, start, end, period) if aligned else [vm.peak]
+            series.append(SimpleNamespace(
+                resource=SimpleNamespace(labels={'instance_id': instance_id}),
+                points=[SimpleNamespace(value=SimpleNamespace(double_value=value / 100.0), interval=interval)
+                        for value, interval in zip(values, intervals)],
+            ))
+        more = offset + self.cloud.page_size < len(instance_ids)
+        return _Pager(SimpleNamespace(time_series=series,
+                                      next_page_token=str(offset + self.cloud.page_size) if more else ""))
+
+# Azure
+
+class FakeAzurePoller:
+    def __init__(self, cloud, token):
+        self.cloud = cloud
+        self.token = token
+        self._done_at = time.monotonic() + cloud.delete_seconds
+
+    def done(self):
+        return time.monotonic() >= self._done_at
+
+    def result(self):
+        return None
+
+    def continuation_token(self):
+        return self.token
+
+class _ItemPaged:
+    """The by_page() surface of azure.core's ItemPaged."""
+
+    def __init__(self, cloud, endpoint, items):
+        self.cloud = cloud
+        self.endpoint = endpoint
+        self.items = items
+
+    def by_page(self):
+        return self._pages()
+
+    def _pages(self):
+        for offset in range(0, max(len(self.items), 1), self.cloud.page_size):
+            self.cloud.call('azure', self.endpoint)
+            yield self.items[offset:offset + self.cloud.page_size]
+
+class FakeAzureVirtualMachines:
+    def __init__(self, cloud, fleet, subscription_id, locations):
+        self.cloud = cloud
+        self.locations = locations
+        self.vms = {f"/subscriptions/{subscription_id}/resourceGroups/rg-{vm.index % 50}/providers/"
+                    f"Microsoft.Compute/virtualMachines/vm-{vm.index}": vm for vm in fleet}
+        self._ids = {(vm_id.split('/')[4], vm_id.split('/')[8]): vm_id for vm_id in self.vms}
+
+    def location(self, vm):
+        return self.locations[vm.index % len(self.locations)]
+
+    def list_all(self, status_only=None):
+        items = [SimpleNamespace(id=vm_id, name=vm_id.split('/')[-1], location=self.location(vm), tags=vm.tags,
+                                 time_created=vm.created, provisioning_state='Succeeded',
+                                 instance_view=SimpleNamespace(statuses=[
+                                     SimpleNamespace(code='ProvisioningState/succeeded'),
+                                     SimpleNamespace(code='PowerState/running' if vm.running
+                                                     else 'PowerState/deallocated')]) if status_only else None)
+                 for vm_id, vm in self.vms.items() if not vm.deleted]
+        return _ItemPaged(self.cloud, 'virtual_machines.list_all', items)
+
+    def begin_delete(self, resource_group, vm_name, continuation_token=None):
+        if continuation_token is None:
+            self.cloud.call('azure', 'virtual_machines.begin_delete')
+        self.vms[self._ids[(resource_group, vm_name)]].deleted = True
+        return FakeAzurePoller(self.cloud, continuation_token or f"token-{vm_name}")
+
+class FakeAzureCompute:
+    def __init__(self, cloud, fleet, subscription_id, locations):
+        self.virtual_machines = FakeAzureVirtualMachines(cloud, fleet, subscription_id, locations)
+
+class FakeResourceGraph:
+    def __init__(self, cloud, compute):
+        self.cloud = cloud
+        self.virtual_machines = compute.virtual_machines
+        self._rows = None
+
+    def resources(self, query):
+        self.cloud.call('azure', 'resources')
+        if self._rows is None:
+            # Evaluated once, as the query result does not change while it is paged
+            vms = self.virtual_machines
+            self._rows = [{'id': vm_id, 'name': vm_id.split('/')[-1], 'location': vms.location(vm),
+                           'resourceGroup': vm_id.split('/')[4], 'tags': vm.tags,
+                           'timeCreated': vm.created.isoformat(), 'state': 'PowerState/running'}
+                          for vm_id, vm in vms.vms.items() if is_prefiltered(vm, check_age=True)]
+        offset = int(query.options.skip_token or 0)
+        more = offset + self.cloud.page_size < len(self._rows)
+        return SimpleNamespace(data=self._rows[offset:offset + self.cloud.page_size],
+                               skip_token=str(offset + self.cloud.page_size) if more else None)
+
+class _MetricValue:
+    # Built once per datapoint, so kept cheaper than a SimpleNamespace
+    __slots__ = ('timestamp', 'maximum')
+
+    def __init__(self, timestamp, maximum):
+        self.timestamp = timestamp
+        self.maximum = maximum
+
+class FakeAzureMetrics:
+    def __init__(self, cloud, compute):
+        self.cloud = cloud
+        self.vms = compute.virtual_machines.vms
+
+    def query_resources(self, resource_ids, metric_namespace, metric_names, timespan, granularity, aggregations):
+        self.cloud.call('azure', 'query_resources')
+        if isinstance(timespan, timedelta):
+            end = datetime.now(timezone.utc)
+            start = end - timespan
+        else:
+            start, end = timespan
+        period = granularity.total_seconds()
+        timestamps = period_starts(start, end, period)
+        results = []
+        for vm_id in resource_ids:
+            vm = self.vms[vm_id]
+            data = list(map(_MetricValue, timestamps, cpu_samples(vm, start, end, period)))
+            results.append(SimpleNamespace(resource_id=vm_id,
+                                           metrics=[SimpleNamespace(timeseries=[SimpleNamespace(data=data)])]))
+        return results
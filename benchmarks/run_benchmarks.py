@@ -0,0 +1,173 @@
+"""Offline benchmark of execute_fallback against local stand-in providers.
+
+Runs FallbackController.execute_fallback over synthetic fleets of each size,
+with the fake clients of fakes.py injected through auth.registry, and reports
+per run the wall time, the peak traced memory and the API calls made per
+endpoint. Nothing leaves the machine.
+
+    python benchmarks/run_benchmarks.py --sizes 1000,10000,100000 --clouds aws
+    python benchmarks/run_benchmarks.py --latency 0.05 --throttle-rate 0.02 --json results.json
+
+--sizes is the number of VMs per selected cloud. The configured provider rate
+limits are lifted unless --rate-limits is given, so the numbers show the tool's
+own cost rather than the waits the limits impose. GCP and Azure runs need the
+SDK packages from requirements.txt, which provide the request and enum types
+the tool builds.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auth
+import controller
+import ratelimit
+from providers import CLOUDS, parse_clouds
+from telemetry import telemetry
+from fakes import (FakeCloud, make_fleet, FakeEC2, FakeCloudWatch, FakeGcpCompute, FakeGcpMonitoring,
+                   FakeAzureCompute, FakeResourceGraph, FakeAzureMetrics)
+
+AWS_BENCHMARK_REGIONS = ["us-east-1", "us-west-2", "eu-west-1", "ap-south-1"]
+GCP_BENCHMARK_ZONES = ["us-central1-a", "us-central1-b", "europe-west1-b"]
+AZURE_BENCHMARK_LOCATIONS = ["eastus", "westeurope"]
+BENCHMARK_PROJECT = "benchmark-project"
+BENCHMARK_SUBSCRIPTION = "00000000-0000-0000-0000-000000000000"
+
+def register_fakes(cloud, clouds, size, seed, workdir):
+    """Build a fleet of size VMs per cloud and register its fake clients; return controller accounts."""
+    auth.registry.clear()
+    accounts = {}
+
+    if "aws" in clouds:
+        fleet = make_fleet(size, seed)
+        for index, region in enumerate(AWS_BENCHMARK_REGIONS):
+            ec2 = FakeEC2(cloud, fleet[index::len(AWS_BENCHMARK_REGIONS)], region, AWS_BENCHMARK_REGIONS)
+            auth.registry.register('aws', 'ec2', ec2, region)
+            auth.registry.register('aws', 'cloudwatch', FakeCloudWatch(cloud, ec2), region)
+            if index == 0:
+                # The default-region clients, used for region discovery
+                auth.registry.register('aws', 'ec2', ec2)
+                auth.registry.register('aws', 'cloudwatch', FakeCloudWatch(cloud, ec2))
+
+    if "gcp" in clouds:
+        compute = FakeGcpCompute(cloud, make_fleet(size, seed + 1), GCP_BENCHMARK_ZONES)
+        auth.registry.register('gcp', 'compute', compute)
+        auth.registry.register('gcp', 'monitoring', FakeGcpMonitoring(cloud, compute))
+
+    if "azure" in clouds:
+        # The controller reads the subscription from the credentials file
+        creds_path = os.path.join(workdir, "azure-creds.json")
+        with open(creds_path, 'w') as f:
+            json.dump({'TENANT_ID': 'benchmark', 'CLIENT_ID': 'benchmark', 'CLIENT_SECRET': 'benchmark',
+                       'SUBSCRIPTION_ID': BENCHMARK_SUBSCRIPTION}, f)
+        accounts["azure"] = creds_path
+        compute = FakeAzureCompute(cloud, make_fleet(size, seed + 2), BENCHMARK_SUBSCRIPTION,
+                                   AZURE_BENCHMARK_LOCATIONS)
+        auth.registry.register('azure', 'compute', compute, account=creds_path)
+        auth.registry.register('azure', 'resourcegraph', FakeResourceGraph(cloud, compute), account=creds_path)
+        for location in AZURE_BENCHMARK_LOCATIONS:
+            auth.registry.register('azure', 'metrics', FakeAzureMetrics(cloud, compute), location, creds_path)
+    return accounts
+
+def run_benchmark(args, size):
+    cloud = FakeCloud(args.latency, args.throttle_rate, args.page_size, args.delete_seconds, seed=args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        accounts = register_fakes(cloud, args.clouds, size, args.seed, workdir)
+        # Limiters keep their adaptive state, so every run starts with fresh ones
+        ratelimit._limiters.clear()
+        telemetry.reset()
+        fallback = controller.FallbackController(concurrent=args.concurrent, clouds=args.clouds, accounts=accounts)
+
+        # The fleet is built; only the tool's own allocations are traced from here
+        tracemalloc.start()
+        started = time.perf_counter()
+        results = fallback.execute_fallback(BENCHMARK_PROJECT)
+        wall_seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'vms_per_cloud': size,
+        'clouds': list(args.clouds),
+        'wall_seconds': round(wall_seconds, 3),
+        'peak_memory_mib': round(peak / 2 ** 20, 2),
+        'deleted': {provider: sum(1 for _, success, _ in vms if success) for provider, vms in results.items()},
+        'api_calls': {f"{provider}.{endpoint}": count for (provider, endpoint), count in sorted(cloud.calls.items())},
+        'throttled': {f"{provider}.{endpoint}": count
+                      for (provider, endpoint), count in sorted(cloud.throttled.items())},
+        'telemetry': telemetry.to_json(),
+    }
+
+def print_report(report):
+    deleted = ", ".join(f"{provider} {count}" for provider, count in report['deleted'].items()
+                        if provider in report['clouds'])
+    print(f"\n{report['vms_per_cloud']} VMs per cloud ({', '.join(report['clouds'])})")
+    print(f"  wall time    {report['wall_seconds']:.3f}s")
+    print(f"  peak memory  {report['peak_memory_mib']:.2f} MiB")
+    print(f"  deleted      {deleted}")
+    print("  API calls")
+    for endpoint, count in report['api_calls'].items():
+        throttled = report['throttled'].get(endpoint)
+        print(f"    {endpoint:<40} {count:>8}" + (f"  ({throttled} throttled)" if throttled else ""))
+    phases = [phase for phase in report['telemetry']['phases'] if phase['seconds'] >= 0.001]
+    if phases:
+        print("  phases")
+        for phase in phases:
+            print(f"    {phase['provider'] + '.' + phase['phase']:<40} {phase['seconds']:>8.3f}s")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark execute_fallback against local fake providers")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        type=lambda value: [int(size) for size in value.split(',')],
+                        help="Comma-separated fleet sizes, in VMs per cloud (default: 1000,10000,100000)")
+    parser.add_argument("--clouds", type=parse_clouds, default=CLOUDS,
+                        help="Comma-separated clouds to benchmark (default: all)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every API call (default: 0)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Share of API calls rejected as throttled (default: 0)")
+    parser.add_argument("--page-size", type=int, default=1000, help="Items per list page (default: 1000)")
+    parser.add_argument("--delete-seconds", type=float, default=0.0,
+                        help="Seconds until a GCP or Azure delete operation completes (default: 0)")
+    parser.add_argument("--concurrent", action="store_true", help="Run the controller in concurrent mode")
+    parser.add_argument("--rate-limits", action="store_true", help="Keep the configured provider rate limits")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic fleets (default: 0)")
+    parser.add_argument("--json", help="Also write the reports to this JSON file")
+    parser.add_argument("--log-level", default="ERROR", help="Logging level of the tool (default: ERROR)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # The controller's cache and journal would carry state from one run into the next
+    controller.METRICS_CACHE_PATH = None
+    controller.RUN_JOURNAL_PATH = None
+    # Regions are listed by the fake instead of the configured ones
+    controller.AWS_REGIONS = []
+    if not args.rate_limits:
+        ratelimit.API_RATE_LIMITS = {}
+        ratelimit.DEFAULT_API_RATE_LIMIT = 1e9
+    if args.throttle_rate:
+        # Keep the backoff proportional to the fake latency instead of real-world seconds
+        ratelimit.RETRY_BASE_DELAY_SECONDS = max(args.latency, 0.01)
+
+    reports = []
+    for size in args.sizes:
+        report = run_benchmark(args, size)
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': {key: value for key, value in vars(args).items() if key != 'json'},
+                       'runs': reports}, f, indent=2)
+        print(f"\nReports written to: {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -28,3 +28,106 @@ AZURE_CPU_THRESHOLD = 5.0
 # VM Age and CPU Check Configuration
 VM_AGE_DAYS = 30
 CPU_CHECK_DAYS = 2
+
+# Idle policy applied to the CPU samples of the check window:
+#   "max"        - every sample is at or below the provider threshold (default)
+#   "percentile" - the CPU_POLICY_PERCENTILE percentile is at or below the threshold
+#   "idle_hours" - at least CPU_POLICY_IDLE_HOURS consecutive hours below the threshold
+#   "idle_share" - at least CPU_POLICY_IDLE_SHARE of the samples below the threshold
+CPU_POLICY = "max"
+CPU_POLICY_PERCENTILE = 95
+CPU_POLICY_IDLE_HOURS = 24
+CPU_POLICY_IDLE_SHARE = 0.95
+
+# VMs evaluated per vectorized policy pass, which bounds memory use
+POLICY_CHUNK_ROWS = 10000
+
+# Maximum number of pooled HTTP connections per SDK client
+CLIENT_POOL_SIZE = 50
+
+# Scan AWS, GCP and Azure in parallel instead of one after another
+CONCURRENT_EXECUTION = False
+
+# Maximum number of concurrent API workers per provider in concurrent mode
+PROVIDER_CONCURRENCY = {
+    "aws": 16,
+    "gcp": 16,
+    "azure": 16,
+}
+
+# How long to wait for GCP and Azure delete operations, and how often to poll them
+DELETE_TIMEOUT_SECONDS = 1800
+DELETE_POLL_INTERVAL_SECONDS = 10
+
+# AWS regions to scan; an empty list scans every region enabled for the account
+AWS_REGIONS = []
+
+# Maximum number of AWS regions scanned in parallel
+AWS_REGION_CONCURRENCY = 8
+
+# Worker processes used when running a shards file
+SHARD_WORKERS = os.cpu_count() or 1
+
+# SQLite file caching per-VM CPU maxima between runs; set YEEDU_METRICS_CACHE to an
+# empty string to always fetch the full CPU_CHECK_DAYS window
+METRICS_CACHE_PATH = os.getenv("YEEDU_METRICS_CACHE", os.path.expanduser("~/Yeedu/cache/metrics.db"))
+
+# Recent datapoints may still be missing when fetched; this much is fetched again next run
+METRICS_SETTLE_SECONDS = 600
+
+# The metrics cache keeps one CPU maximum per VM and bucket of this many seconds
+METRICS_BUCKET_SECONDS = 3600
+
+# Push the REQUIRED_TAGS, running-state and (on Azure) age predicates to the
+# provider list calls so that only candidate VMs are listed
+SERVER_SIDE_PREFILTER = True
+
+# Maximum number of items buffered between two controller pipeline stages
+PIPELINE_QUEUE_SIZE = 1000
+
+# VMs per metrics request group in the controller pipeline
+METRICS_BATCH_SIZES = {
+    "aws": 500,
+    "gcp": 100,
+    "azure": 500,
+}
+
+
+# Requests per second allowed per (provider, API); APIs not listed use DEFAULT_API_RATE_LIMIT
+API_RATE_LIMITS = {
+    ("aws", "describe"): 20,
+    ("aws", "metrics"): 50,
+    ("aws", "delete"): 5,
+    ("gcp", "list"): 20,
+    ("gcp", "metrics"): 100,
+    ("gcp", "delete"): 10,
+    ("gcp", "operations"): 20,
+    ("azure", "list"): 10,
+    ("azure", "metrics"): 50,
+    ("azure", "delete"): 5,
+}
+DEFAULT_API_RATE_LIMIT = 10
+
+# Maximum concurrent calls per (provider, API). Halved on every throttling response
+# and raised by one again after RATE_LIMIT_INCREASE_AFTER successful calls
+API_MAX_CONCURRENCY = 16
+RATE_LIMIT_INCREASE_AFTER = 20
+
+# Retries of throttled calls; without a Retry-After header the delay doubles per
+# attempt from RETRY_BASE_DELAY_SECONDS up to RETRY_MAX_DELAY_SECONDS
+RETRY_MAX_ATTEMPTS = 6
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 60.0
+
+# SQLite run journal used by --resume; set YEEDU_RUN_JOURNAL to an empty string to disable it
+RUN_JOURNAL_PATH = os.getenv("YEEDU_RUN_JOURNAL", os.path.expanduser("~/Yeedu/journal/runs.db"))
+
+# Daemon mode: seconds between inventory refreshes, and the delay before a VM is
+# evaluated again when its next possible qualification time is unknown
+DAEMON_REFRESH_SECONDS = 3600
+DAEMON_RECHECK_SECONDS = 6 * 3600
+
+# Report of phase timings and API call counters written at the end of every run:
+# a Prometheus textfile, or JSON when the path ends in .json. Set YEEDU_RUN_METRICS
+# to an empty string to disable it
+RUN_METRICS_PATH = os.getenv("YEEDU_RUN_METRICS", os.path.expanduser("~/Yeedu/metrics/fallback.prom"))
@@ -1,100 +1,335 @@
 import logging
-from auth import get_aws_client, get_gcp_client, get_azure_client
-from utils import check_required_tags, remove_vm
-from aws_fallback import has_low_usage_aws
-from gcp_fallback import has_low_usage_gcp
-from azure_fallback import has_low_usage_azure
-from config import AZURE_CREDS_PATH
-import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from auth import (get_aws_client, get_gcp_client, get_gcp_zone_operations_client, get_azure_client,
+                  get_azure_resource_graph_client, load_credentials)
+from utils import (bounded_map, terminate_instances_aws, begin_remove_gcp, begin_remove_azure, DeletionTracker,
+                   GcpZoneOperation, AWS_TERMINATE_BATCH_SIZE)
+from pipeline import run_pipeline, batched, imap_bounded
+from metrics_cache import MetricsCache
+from journal import RunJournal
+from records import VMRecord
+from inventory import discover_aws_regions, iter_aws_instances, iter_gcp_instances, iter_azure_vms, iter_azure_graph_vms
+from providers import CLOUDS, load_provider
+from telemetry import telemetry
+from config import (AZURE_CREDS_PATH, CONCURRENT_EXECUTION, PROVIDER_CONCURRENCY, AWS_REGIONS, AWS_REGION_CONCURRENCY,
+                    METRICS_CACHE_PATH, SERVER_SIDE_PREFILTER, CPU_POLICY, AWS_CPU_THRESHOLD, GCP_CPU_THRESHOLD,
+                    AZURE_CPU_THRESHOLD, METRICS_BATCH_SIZES, RUN_JOURNAL_PATH)
 
 logger = logging.getLogger(__name__)
 
 class FallbackController:
-    def __init__(self):
+    def __init__(self, concurrent=CONCURRENT_EXECUTION, concurrency=None, clouds=CLOUDS, accounts=None,
+                 azure_subscription_id=None, run_id=None):
         logger.info("Initializing FallbackController")
-        # AWS clients
-        self.ec2 = get_aws_client('ec2')
-        self.cloudwatch = get_aws_client('cloudwatch')
-        
-        # GCP clients
-        self.gcp_compute = get_gcp_client()
-        
-        # Azure clients
-        self.azure_compute = get_azure_client()
-        with open(AZURE_CREDS_PATH, 'r') as f:
-            data = json.load(f)
+        # In concurrent mode providers are scanned in parallel and each provider
+        # evaluates its VMs with up to concurrency[provider] threads
+        self.concurrent = concurrent
+        self.concurrency = dict(PROVIDER_CONCURRENCY, **(concurrency or {}))
+        # Only the selected clouds get clients; accounts maps a cloud to its
+        # credentials file when it differs from the configured default
+        self.clouds = tuple(clouds)
+        self.metrics_cache = MetricsCache(METRICS_CACHE_PATH) if METRICS_CACHE_PATH else None
+        # Outcomes are journaled under run_id (see RunJournal.begin_run) when one is given
+        self.journal = RunJournal(RUN_JOURNAL_PATH, run_id) if RUN_JOURNAL_PATH and run_id is not None else None
+        self.accounts = dict.fromkeys(CLOUDS, None)
+        self.accounts.update(accounts or {})
+
+        if "aws" in self.clouds:
+            # AWS clients
+            self.ec2 = get_aws_client('ec2', account=self.accounts["aws"])
+            self.cloudwatch = get_aws_client('cloudwatch', account=self.accounts["aws"])
+
+        if "gcp" in self.clouds:
+            # GCP clients
+            self.gcp_compute = get_gcp_client(self.accounts["gcp"])
+
+        if "azure" in self.clouds:
+            # Azure clients
+            self.azure_compute = get_azure_client(self.accounts["azure"], azure_subscription_id)
+            data = load_credentials(self.accounts["azure"] or AZURE_CREDS_PATH)
             self.azure_creds = {
                 'tenant_id': data['TENANT_ID'],
                 'client_id': data['CLIENT_ID'],
                 'client_secret': data['CLIENT_SECRET'],
-                'subscription_id': data['SUBSCRIPTION_ID']
+                'subscription_id': azure_subscription_id or data['SUBSCRIPTION_ID']
             }
 
     def get_aws_machines(self):
         logger.info("Fetching AWS vms for fallback")
+        regions = AWS_REGIONS or discover_aws_regions(self.ec2)
         results = []
-        instances = self.ec2.describe_instances()
-        for reservation in instances['Reservations']:
-            for instance in reservation['Instances']:
-                instance_id = instance['InstanceId']
-                logger.info(f"Checking AWS instance: {instance_id}")
-                if has_low_usage_aws(instance_id, self.ec2, self.cloudwatch):
-                    logger.info(f"Instance {instance_id} has low usage. Attempting to remove.")
-                    success, message = remove_vm(self.ec2, instance_id)
-                    results.append((instance_id, success, message))
+        for region_results in bounded_map(self.get_aws_region_machines, regions, AWS_REGION_CONCURRENCY):
+            results.extend(region_results)
         logger.info("AWS vms evaluation completed")
         return results
 
-    def get_gcp_machines(self, project_id):
+    def get_aws_region_machines(self, region, inventory=None):
+        """Evaluate the instances of one region; inventory replaces the listing when given."""
+        logger.info(f"Fetching AWS vms in region: {region}")
+        # Every region needs its own EC2 and CloudWatch endpoints
+        ec2 = get_aws_client('ec2', region, self.accounts["aws"])
+        cloudwatch = get_aws_client('cloudwatch', region, self.accounts["aws"])
+        aws = load_provider("aws")
+
+        def is_candidate(instance):
+            logger.debug(f"Checking AWS instance: {instance.id}")
+            return aws.is_aws_candidate(instance, ec2)
+
+        def delete(instances):
+            for batch in batched(instances, AWS_TERMINATE_BATCH_SIZE):
+                for instance in batch:
+                    logger.info(f"Instance {instance.id} has low usage. Attempting to remove.")
+                yield from self.journal_results("aws", terminate_instances_aws(ec2, [instance.id for instance in batch]))
+
+        try:
+            return self.run_provider_pipeline(
+                "aws",
+                iter_aws_instances(ec2, SERVER_SIDE_PREFILTER) if inventory is None else inventory,
+                is_candidate,
+                lambda instances: aws.get_cpu_maxima_aws(cloudwatch, [instance.id for instance in instances], 1),
+                lambda instances, start, end: aws.get_cpu_buckets_aws(
+                    cloudwatch, [instance.id for instance in instances], 1, start, end),
+                lambda instances: aws.get_cpu_series_aws(
+                    cloudwatch, [instance.id for instance in instances], 1),
+                AWS_CPU_THRESHOLD,
+                aws.is_low_cpu_aws,
+                delete,
+            )
+        except Exception as e:
+            logger.error(f"AWS fallback failed in region {region}: {e}")
+            return []
+
+    def get_gcp_machines(self, project_id, inventory=None):
+        """Evaluate the instances of a project; inventory replaces the listing when given."""
         logger.info("Fetching GCP vms for fallback")
-        results = []
-        request = {"project": project_id}
-        agg_list = self.gcp_compute.aggregated_list(request=request)
+        gcp = load_provider("gcp")
+
+        def is_candidate(instance):
+            logger.debug(f"Checking GCP instance: {instance.id} in zone: {instance.location}")
+            return gcp.is_gcp_candidate(instance, self.gcp_compute)
 
-        for zone_result in agg_list:
-            zone = zone_result[0].split("/")[-1]
-            instances = zone_result[1].instances if zone_result[1].instances else []
+        def delete(instances):
+            # Fire every delete as it arrives, then track the operations together
+            tracker = DeletionTracker("gcp")
+            for vm_id, name, operation_id in self.pending_deletes("gcp"):
+                operation_project, zone, operation_name = operation_id.split('/')
+                if operation_project == project_id:
+                    logger.info(f"Re-attaching to pending delete of instance {vm_id}")
+                    operations_client = get_gcp_zone_operations_client(self.accounts["gcp"])
+                    tracker.attach(vm_id, GcpZoneOperation(operations_client, project_id, zone, operation_name),
+                                   f"GCP instance {name} deleted")
             for instance in instances:
-                instance_id = instance.id
-                instance_name = instance.name
-                logger.info(f"Checking GCP instance: {instance_id} in zone: {zone}")
-
-                if has_low_usage_gcp(project_id, instance_id, zone, self.gcp_compute):
-                    logger.info(f"Instance {instance_id} has low usage. Attempting to remove.")
-                    success, message = remove_vm(self.gcp_compute, project_id, zone, instance_name)
-                    results.append((instance_id, success, message))
+                logger.info(f"Instance {instance.id} has low usage. Attempting to remove.")
+                operation = tracker.submit(
+                    instance.id,
+                    lambda: begin_remove_gcp(self.gcp_compute, instance),
+                    f"GCP instance {instance.name} deleted",
+                )
+                if operation is not None and self.journal:
+                    self.journal.record("gcp", [(instance.id, instance.name, "deleting",
+                                                 f"{project_id}/{instance.location}/{operation.name}", None)])
+            yield from self.journal_results("gcp", tracker.wait())
+
+        results = self.run_provider_pipeline(
+            "gcp",
+            iter_gcp_instances(self.gcp_compute, project_id, SERVER_SIDE_PREFILTER) if inventory is None else inventory,
+            is_candidate,
+            lambda instances: gcp.get_cpu_maxima_gcp(
+                project_id, [instance.id for instance in instances], self.accounts["gcp"]),
+            lambda instances, start, end: gcp.get_cpu_buckets_gcp(
+                project_id, [instance.id for instance in instances], self.accounts["gcp"], start, end),
+            lambda instances: gcp.get_cpu_series_gcp(
+                project_id, [instance.id for instance in instances], self.accounts["gcp"]),
+            GCP_CPU_THRESHOLD,
+            gcp.is_low_cpu_gcp,
+            delete,
+        )
         logger.info("GCP vms evaluation completed")
         return results
 
-    def get_azure_machines(self):
+    def get_azure_machines(self, inventory=None, by_id=False):
+        """Evaluate the VMs of the subscription; inventory replaces the listing when given.
+
+        Results are reported by VM name, or by resource id when by_id is set, as
+        names are only unique within a resource group.
+        """
         logger.info("Fetching Azure vms for fallback")
-        results = []
-        for vm in self.azure_compute.virtual_machines.list_all():
-            logger.info(f"Checking Azure VM: {vm.id}")
-            if has_low_usage_azure(vm.id, self.azure_compute, self.azure_creds):
+        azure = load_provider("azure")
+
+        def is_candidate(vm):
+            logger.debug(f"Checking Azure VM: {vm.id}")
+            return azure.is_azure_candidate(vm, self.azure_compute)
+
+        def delete(vms):
+            # Fire every delete as it arrives, then track the pollers together
+            tracker = DeletionTracker("azure")
+            # Deletes are tracked and journaled by resource id and reported by name
+            names = {}
+            subscription = f"/subscriptions/{self.azure_creds['subscription_id']}/".lower()
+            for vm_id, name, continuation_token in self.pending_deletes("azure"):
+                if vm_id.lower().startswith(subscription):
+                    logger.info(f"Re-attaching to pending delete of VM {vm_id}")
+                    names[vm_id] = name
+                    tracker.submit(
+                        vm_id,
+                        lambda: begin_remove_azure(self.azure_compute, VMRecord.from_azure_id(vm_id),
+                                                   continuation_token),
+                        f"Azure VM {name} deleted",
+                    )
+            for vm in vms:
                 logger.info(f"VM {vm.id} has low usage. Attempting to remove.")
-                success, message = remove_vm(self.azure_compute, vm.id)
-                results.append((vm.name, success, message))
+                names[vm.id] = vm.name
+                poller = tracker.submit(
+                    vm.id,
+                    lambda: begin_remove_azure(self.azure_compute, vm),
+                    f"Azure VM {vm.name} deleted",
+                )
+                if poller is not None and self.journal:
+                    self.journal.record("azure", [(vm.id, vm.name, "deleting", poller.continuation_token(), None)])
+            yield from self.journal_results("azure", tracker.wait(), None if by_id else names)
+
+        results = self.run_provider_pipeline(
+            "azure",
+            self.iter_azure_inventory() if inventory is None else inventory,
+            is_candidate,
+            lambda vms: azure.get_cpu_maxima_azure(vms, self.accounts["azure"], 1),
+            lambda vms, start, end: azure.get_cpu_buckets_azure(vms, self.accounts["azure"], 1, start, end),
+            lambda vms: azure.get_cpu_series_azure(vms, self.accounts["azure"], 1),
+            AZURE_CPU_THRESHOLD,
+            azure.is_low_cpu_azure,
+            delete,
+        )
         logger.info("Azure vms evaluation completed")
         return results
 
+    def iter_azure_inventory(self):
+        if SERVER_SIDE_PREFILTER:
+            resource_graph = get_azure_resource_graph_client(self.accounts["azure"])
+            return iter_azure_graph_vms(resource_graph, self.azure_creds['subscription_id'])
+        return iter_azure_vms(self.azure_compute)
+
+    def run_provider_pipeline(self, provider, inventory, is_candidate, fetch_maxima, fetch_buckets, fetch_series,
+                              threshold, is_low_cpu, delete):
+        """Stream one provider's VMs through inventory -> filter -> metrics -> decision -> deletion.
+
+        inventory yields VMRecords page by page. is_candidate applies the
+        cheap tag and age checks. Candidates are grouped into batches of
+        METRICS_BATCH_SIZES[provider] and the CPU data of each batch is fetched
+        (see fetch_cpu) for up to concurrency[provider] batches at once, while
+        inventory pages are still arriving. As the batches already run in
+        parallel, the fetch functions are given a single worker and start no
+        threads of their own. The decision stage applies is_low_cpu
+        (or the vectorized CPU_POLICY) and delete turns the stream of idle
+        records into (id, success, message) tuples, which are returned.
+        With a run journal, VMs already settled in the run are skipped and busy
+        candidates are recorded as kept.
+        """
+        settled = self.journal.settled_ids(provider) if self.journal else set()
+        if settled:
+            logger.info(f"Skipping {len(settled)} {provider.upper()} VMs already handled in this run")
+
+        def filter_stage(records):
+            return (record for record in records if record.id not in settled and is_candidate(record))
+
+        def metrics_stage(candidates):
+            return imap_bounded(
+                lambda batch: (batch, self.fetch_cpu(provider, batch, fetch_maxima, fetch_buckets, fetch_series)),
+                batched(candidates, METRICS_BATCH_SIZES[provider]), self._workers(provider))
+
+        def decision_stage(batches):
+            for batch, cpu_values in batches:
+                with telemetry.span(provider, "decision"):
+                    idle = self.decide_low_usage(cpu_values, threshold, is_low_cpu)
+                if self.journal:
+                    self.journal.record(provider, [(record.id, record.name, "kept", None, None)
+                                                   for record in batch if record.id not in idle])
+                yield from (record for record in batch if record.id in idle)
+
+        inventory = telemetry.timed_iter(provider, "list", inventory)
+        return list(run_pipeline(inventory, [filter_stage, metrics_stage, decision_stage, delete]))
+
+    def fetch_cpu(self, provider, records, fetch_maxima, fetch_buckets, fetch_series):
+        """Return the CPU data the active CPU_POLICY needs for records, keyed by VM id.
+
+        The default "max" policy only needs the window maxima, which come from the
+        metrics cache when possible. Any other policy needs the full series.
+        fetch_maxima(records), fetch_buckets(records, start, end) and
+        fetch_series(records) return the provider's data keyed by VM id.
+        """
+        with telemetry.span(provider, "metrics"):
+            if CPU_POLICY == "max":
+                return self.cached_cpu_maxima(provider, records, fetch_maxima, fetch_buckets)
+            return fetch_series(records)
+
+    def decide_low_usage(self, cpu_values, threshold, is_low_cpu):
+        """Return the ids of the VMs whose CPU data qualifies them for removal."""
+        if CPU_POLICY == "max":
+            return {vm_id for vm_id, cpu_max in cpu_values.items() if is_low_cpu(vm_id, cpu_max)}
+        # NumPy is only needed by the series policies
+        from policy import evaluate_policy
+        idle = evaluate_policy(cpu_values, threshold, CPU_POLICY)
+        return {vm_id for vm_id, is_idle in idle.items() if is_idle}
+
+    def cached_cpu_maxima(self, provider, records, fetch_maxima, fetch_buckets):
+        """Return CPU maxima over the window, fetching only what the metrics cache lacks.
+
+        fetch_buckets(records, start, end) returns the per-period maxima of the
+        given VMs between two UTC datetimes (see MetricsCache.store). Without a
+        cache, fetch_maxima(records) returns the maxima over the whole window.
+        """
+        if self.metrics_cache is None:
+            return fetch_maxima(records)
+
+        now = time.time()
+        self.metrics_cache.evict(now)
+        end = datetime.fromtimestamp(now, timezone.utc)
+        records_by_id = {record.id: record for record in records}
+        for start, ids in self.metrics_cache.plan(provider, list(records_by_id), now).items():
+            buckets = fetch_buckets([records_by_id[vm_id] for vm_id in ids],
+                                    datetime.fromtimestamp(start, timezone.utc), end)
+            self.metrics_cache.store(provider, buckets, start, now)
+        return self.metrics_cache.window_maxima(provider, list(records_by_id), now)
+
+    def pending_deletes(self, provider):
+        return self.journal.pending_deletes(provider) if self.journal else []
+
+    def journal_results(self, provider, results, names=None):
+        """Record (id, success, message) deletion results in the run journal as they stream past.
+
+        names maps a VM id to the name the result is reported under, when given.
+        """
+        for vm_id, success, msg in results:
+            if self.journal:
+                self.journal.record(provider, [(vm_id, None, "deleted" if success else "failed", None, msg)])
+            yield (names or {}).get(vm_id, vm_id), success, msg
+
+    def _workers(self, provider):
+        return self.concurrency[provider] if self.concurrent else 1
+
     def execute_fallback(self, project_id):
         logger.info("Executing fallback detection")
         results = {"aws": [], "gcp": [], "azure": []}
-        try:
-            results["aws"] = self.get_aws_machines()  
-            pass
-        except Exception as e:
-            logger.error(f"AWS fallback failed: {e}")
-        try:
-            results["gcp"] = self.get_gcp_machines(project_id)
-            pass
-        except Exception as e:
-            logger.error(f"GCP fallback failed: {e}")
-        try:
-            results["azure"] = self.get_azure_machines()  
-            pass
-        except Exception as e:
-            logger.error(f"Azure fallback failed: {e}")
+        providers = [
+            ("aws", "AWS", self.get_aws_machines, ()),
+            ("gcp", "GCP", self.get_gcp_machines, (project_id,)),
+            ("azure", "Azure", self.get_azure_machines, ()),
+        ]
+        providers = [provider for provider in providers if provider[0] in self.clouds]
+
+        def run(provider):
+            key, label, get_machines, args = provider
+            try:
+                results[key] = get_machines(*args)
+            except Exception as e:
+                logger.error(f"{label} fallback failed: {e}")
+
+        if self.concurrent:
+            with ThreadPoolExecutor(max_workers=max(len(providers), 1)) as executor:
+                list(executor.map(run, providers))
+        else:
+            for provider in providers:
+                run(provider)
         logger.info("Fallback detection completed")
         return results
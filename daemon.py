@@ -0,0 +1,210 @@
+import heapq
+import itertools
+import threading
+import time
+import logging
+from datetime import timedelta
+from inventory import discover_aws_regions, iter_aws_instances, iter_gcp_instances
+from auth import get_aws_client
+from utils import tags_match, summarize_results
+from records import Fleet
+from telemetry import telemetry
+from config import (AWS_REGIONS, SERVER_SIDE_PREFILTER, VM_AGE_DAYS, CPU_POLICY, AWS_CPU_THRESHOLD,
+                    GCP_CPU_THRESHOLD, AZURE_CPU_THRESHOLD, DAEMON_REFRESH_SECONDS, DAEMON_RECHECK_SECONDS,
+                    RUN_METRICS_PATH)
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Busy thresholds in the unit the metrics cache stores maxima in (GCP reports fractions)
+CACHE_THRESHOLDS = {
+    "aws": AWS_CPU_THRESHOLD,
+    "gcp": GCP_CPU_THRESHOLD / 100.0,
+    "azure": AZURE_CPU_THRESHOLD,
+}
+
+# Record fields whose change may make a VM qualify earlier or later
+TRACKED_FIELDS = ('tags', 'created', 'state')
+
+class FallbackDaemon:
+    """Keeps the inventory in memory and evaluates each VM only when it can next qualify.
+
+    Every DAEMON_REFRESH_SECONDS each scope (an AWS region, the GCP project or the
+    Azure subscription) is listed again and diffed against the previous listing:
+    new or changed VMs are (re)scheduled and vanished VMs are dropped. VMs wait
+    in a priority queue keyed on their next possible qualification time, which
+    is the later of
+      - the moment they reach VM_AGE_DAYS, and
+      - after an evaluation that kept them, the moment their latest cached CPU
+        maximum above threshold leaves the CPU_CHECK_DAYS window (with the "max"
+        policy and a metrics cache), or DAEMON_RECHECK_SECONDS otherwise.
+    Only due VMs go through the controller pipeline, so the work per cycle is
+    proportional to what changed or became due rather than to the fleet size.
+    """
+
+    def __init__(self, controller, project_id, refresh_seconds=DAEMON_REFRESH_SECONDS,
+                 metrics_path=RUN_METRICS_PATH):
+        self.controller = controller
+        # Telemetry keeps accumulating and is written out after every cycle that did work
+        self.metrics_path = metrics_path
+        self.project_id = project_id
+        self.refresh_seconds = refresh_seconds
+        # (provider, scope) -> Fleet of the VMs listed in that scope
+        self.inventory = {}
+        # Heap of (due, sequence, (provider, scope, vm_id)); rescheduling pushes a
+        # new entry and leaves the old one to be skipped when popped
+        self._queue = []
+        self._scheduled = {}
+        # VMs deleted by the daemon stay listed while they shut down; they are not scheduled again
+        self._deleted = set()
+        self._sequence = itertools.count()
+        self._stop = threading.Event()
+
+    def scopes(self):
+        scopes = []
+        if "aws" in self.controller.clouds:
+            regions = AWS_REGIONS or discover_aws_regions(self.controller.ec2)
+            scopes.extend(("aws", region) for region in regions)
+        if "gcp" in self.controller.clouds:
+            scopes.append(("gcp", self.project_id))
+        if "azure" in self.controller.clouds:
+            scopes.append(("azure", self.controller.azure_creds['subscription_id']))
+        return scopes
+
+    def list_scope(self, provider, scope):
+        if provider == "aws":
+            ec2 = get_aws_client('ec2', scope, self.controller.accounts["aws"])
+            return iter_aws_instances(ec2, SERVER_SIDE_PREFILTER)
+        if provider == "gcp":
+            return iter_gcp_instances(self.controller.gcp_compute, scope, SERVER_SIDE_PREFILTER)
+        return self.controller.iter_azure_inventory()
+
+    def evaluate_scope(self, provider, scope, records):
+        if provider == "aws":
+            return self.controller.get_aws_region_machines(scope, records)
+        if provider == "gcp":
+            return self.controller.get_gcp_machines(scope, records)
+        return self.controller.get_azure_machines(records, by_id=True)
+
+    def refresh(self, scopes, now):
+        """List every scope again and schedule what changed since the previous listing."""
+        added = changed = removed = 0
+        for provider, scope in scopes:
+            try:
+                current = Fleet(provider, self.list_scope(provider, scope))
+            except Exception as e:
+                logger.error(f"Refreshing {provider.upper()} {scope} failed, keeping the previous inventory: {e}")
+                continue
+            previous = self.inventory.get((provider, scope), Fleet(provider))
+            for record in current:
+                vm_id = record.id
+                if (provider, scope, vm_id) in self._deleted:
+                    continue
+                old = previous.get(vm_id)
+                if old is None:
+                    added += 1
+                elif any(getattr(old, field) != getattr(record, field) for field in TRACKED_FIELDS):
+                    changed += 1
+                else:
+                    continue
+                self.schedule((provider, scope, vm_id), record, now)
+            for vm_id in previous.keys() - current.keys():
+                removed += 1
+                self._scheduled.pop((provider, scope, vm_id), None)
+                self._deleted.discard((provider, scope, vm_id))
+            self.inventory[(provider, scope)] = current
+        logger.info(f"Inventory refreshed: {added} new, {changed} changed, {removed} removed VMs; "
+                    f"{len(self._scheduled)} scheduled")
+
+    def qualification_time(self, record, now):
+        """Return the earliest time record can pass the age check, None if its tags never match."""
+        if not tags_match(record.tags):
+            return None
+        if record.created is None:
+            return now
+        return max(now, (record.created + timedelta(days=VM_AGE_DAYS)).timestamp())
+
+    def schedule(self, key, record, now, not_before=None):
+        due = self.qualification_time(record, now)
+        if due is None:
+            self._scheduled.pop(key, None)
+            return
+        if not_before is not None:
+            due = max(due, not_before)
+        sequence = next(self._sequence)
+        self._scheduled[key] = sequence
+        heapq.heappush(self._queue, (due, sequence, key))
+
+    def pop_due(self, now):
+        """Remove and return the keys of all VMs due at now, grouped by (provider, scope)."""
+        due = {}
+        while self._queue and self._queue[0][0] <= now:
+            _, sequence, key = heapq.heappop(self._queue)
+            if self._scheduled.get(key) != sequence:
+                continue  # superseded or dropped
+            del self._scheduled[key]
+            provider, scope, vm_id = key
+            due.setdefault((provider, scope), []).append(vm_id)
+        return due
+
+    def next_due(self):
+        while self._queue and self._scheduled.get(self._queue[0][2]) != self._queue[0][1]:
+            heapq.heappop(self._queue)
+        return self._queue[0][0] if self._queue else None
+
+    def evaluate_due(self, due, now):
+        results = {"aws": [], "gcp": [], "azure": []}
+        for (provider, scope), vm_ids in due.items():
+            fleet = self.inventory.get((provider, scope), Fleet(provider))
+            batch = [fleet.get(vm_id) for vm_id in vm_ids if vm_id in fleet]
+            logger.info(f"Evaluating {len(batch)} due {provider.upper()} VMs in {scope}")
+            try:
+                scope_results = self.evaluate_scope(provider, scope, batch)
+            except Exception as e:
+                logger.error(f"{provider.upper()} evaluation in {scope} failed: {e}")
+                scope_results = []
+            results[provider].extend(scope_results)
+
+            deleted = {vm_id for vm_id, success, msg in scope_results if success}
+            recheck = self.recheck_times(provider, [record.id for record in batch], time.time())
+            for record in batch:
+                key = (provider, scope, record.id)
+                if record.id in deleted:
+                    self._deleted.add(key)
+                    continue
+                self.schedule(key, record, now, recheck[record.id])
+        return results
+
+    def recheck_times(self, provider, vm_ids, now):
+        """Return when each kept VM should be evaluated again."""
+        recheck = dict.fromkeys(vm_ids, now + DAEMON_RECHECK_SECONDS)
+        cache = self.controller.metrics_cache
+        if CPU_POLICY == "max" and cache is not None:
+            recheck.update(cache.busy_until(provider, vm_ids, CACHE_THRESHOLDS[provider], now))
+        return recheck
+
+    def run(self):
+        """Refresh and evaluate until stop() is called."""
+        scopes = self.scopes()
+        logger.info(f"Daemon started for {len(scopes)} scopes, refreshing every {self.refresh_seconds}s")
+        next_refresh = 0.0
+        while not self._stop.is_set():
+            now = time.time()
+            if now >= next_refresh:
+                self.refresh(scopes, now)
+                next_refresh = now + self.refresh_seconds
+            due = self.pop_due(now)
+            if due:
+                summary = summarize_results(self.evaluate_due(due, now))
+                for cloud, stats in summary.items():
+                    if stats['total']:
+                        logger.info(f"{cloud.upper()}: Total={stats['total']}, Success={stats['success']}, "
+                                    f"Failed={stats['failed']}")
+                if self.metrics_path:
+                    telemetry.export(self.metrics_path)
+            next_due = self.next_due()
+            wake = next_refresh if next_due is None else min(next_refresh, next_due)
+            self._stop.wait(max(wake - time.time(), 0))
+
+    def stop(self):
+        self._stop.set()
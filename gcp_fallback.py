@@ -1,87 +1,183 @@
 from datetime import datetime, timedelta
 import time
-from google.cloud import monitoring_v3
-from utils import check_required_tags
-from config import GCP_CPU_THRESHOLD, GCP_CREDS_PATH, VM_AGE_DAYS, CPU_CHECK_DAYS
+from utils import check_required_tags, tags_match
+from auth import get_gcp_monitoring_client
+from ratelimit import iter_gcp_pages
+from records import VMRecord
+from inventory import describe_vm
+from telemetry import telemetry
+from config import GCP_CPU_THRESHOLD, VM_AGE_DAYS, CPU_CHECK_DAYS, METRICS_BUCKET_SECONDS
 import logging
-import os
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def get_instance_creation_time(compute_client, project_id, zone, instance_id):
+# Largest instance id list sent in a one_of() monitoring filter
+FILTER_MAX_INSTANCE_IDS = 100
+
+def get_instance_creation_time(compute_client, instance):
     try:
-        # Use the correct method to get instance details
-        request = compute_client.get(
-            project=project_id,
-            zone=zone,
-            instance=instance_id
-        )
-        response = request
-        creation_time = datetime.fromisoformat(response.creation_timestamp.replace('Z', '+00:00'))
-        return creation_time
+        return describe_vm(compute_client, instance).created
     except Exception as e:
-        logger.error(f"Error while fetching creation time for instance {instance_id}: {e}")
+        logger.error(f"Error while fetching creation time for instance {instance.id}: {e}")
         return None
 
-def has_low_usage_gcp(project_id, instance_id, zone, compute_client):
-    logger.info(f"Checking low usage for GCP instance: {instance_id} in zone: {zone}")
-    try:
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GCP_CREDS_PATH
-        logger.info(f"Using GCP credentials from: {GCP_CREDS_PATH}")
+def is_gcp_candidate(instance, compute_client):
+    """Check the required labels, the running status and the minimum age of an instance.
 
-        instance_id_str = str(instance_id)
+    The labels, status and creation timestamp of the VMRecord are used when the
+    listing filled them in; otherwise the instance is fetched.
+    """
+    instance_id = instance.id
 
-        if not check_required_tags(compute_client, project_id, zone, instance_id_str):
-            logger.info(f"Instance {instance_id} does not have all required tags.")
-            return False
+    with telemetry.span("gcp", "tags"):
+        if instance.tags is not None:
+            has_tags = tags_match(instance.tags)
+        else:
+            has_tags = check_required_tags(compute_client, instance)
+    if not has_tags:
+        logger.debug(f"Instance {instance_id} does not have all required tags.")
+        return False
 
-        # Check instance age
-        creation_time = get_instance_creation_time(compute_client, project_id, zone, instance_id_str)
-        if not creation_time:
-            logger.error(f"Could not determine creation time for instance {instance_id}")
-            return False
+    if instance.state != 'RUNNING':
+        logger.debug(f"Instance {instance_id} is {instance.state}.")
+        return False
 
-        instance_age = datetime.now(creation_time.tzinfo) - creation_time
-        if instance_age.days < VM_AGE_DAYS:
-            logger.info(f"Instance {instance_id} is {instance_age.days} days old.")
-            logger.info(f"Instance {instance_id} is less than {VM_AGE_DAYS} days old. Skipping.")
-            return False
+    # Check instance age
+    with telemetry.span("gcp", "age"):
+        creation_time = instance.created or get_instance_creation_time(compute_client, instance)
+    if not creation_time:
+        logger.error(f"Could not determine creation time for instance {instance_id}")
+        return False
 
-        logger.info(f"Instance {instance_id} is {instance_age.days} days old. Checking CPU utilization.")
+    instance_age = datetime.now(creation_time.tzinfo) - creation_time
+    if instance_age.days < VM_AGE_DAYS:
+        logger.debug(f"Instance {instance_id} is {instance_age.days} days old.")
+        logger.debug(f"Instance {instance_id} is less than {VM_AGE_DAYS} days old. Skipping.")
+        return False
 
-        # Get CPU metrics for the last 2 days
-        client = monitoring_v3.MetricServiceClient()
-        now = time.time()
-        interval = monitoring_v3.TimeInterval({
-            "end_time": {"seconds": int(now)},
-            "start_time": {"seconds": int(now - CPU_CHECK_DAYS * 24 * 3600)},
-        })
-
-        cpu_filter = (
-            f'metric.type="compute.googleapis.com/instance/cpu/utilization" '
-            f'AND resource.labels.instance_id="{instance_id}"'
-        )
-
-        results = client.list_time_series(
-            request={
-                "name": f"projects/{project_id}",
-                "filter": cpu_filter,
-                "interval": interval,
-                "view": monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
-                "aggregation": {
-                    "alignment_period": {"seconds": 300},  # 5-minute granularity
-                    "per_series_aligner": monitoring_v3.Aggregation.Aligner.ALIGN_MAX,
-                }
+    logger.debug(f"Instance {instance_id} is {instance_age.days} days old. Checking CPU utilization.")
+    return True
+
+def get_cpu_maxima_gcp(project_id, instance_ids=None, account=None, start=None, end=None):
+    """Return the maximum CPU utilization (0.0-1.0) per instance between start and end.
+
+    The range defaults to the last CPU_CHECK_DAYS. A single list_time_series call
+    is made, filtered on the instance ids when there are at most
+    FILTER_MAX_INSTANCE_IDS of them and project-wide otherwise, and its pages are
+    streamed. The whole range is aligned server-side with ALIGN_MAX and reduced
+    with REDUCE_MAX grouped by instance id, so each instance contributes one value
+    instead of one point per 5 minutes. When instance_ids is given, only those instances are returned and
+    instances without data map to None.
+    """
+    maxima = {}
+    for instance_id, point in _list_cpu_points(project_id, instance_ids, account, start, end, None):
+        value = point.value.double_value
+        current = maxima.get(instance_id)
+        maxima[instance_id] = value if current is None else max(current, value)
+
+    if instance_ids is None:
+        return maxima
+    return {str(instance_id): maxima.get(str(instance_id)) for instance_id in instance_ids}
+
+def get_cpu_series_gcp(project_id, instance_ids=None, account=None, start=None, end=None):
+    """Return the 5-minute CPU utilization maxima per instance, in percent, between start and end.
+
+    Uses the same project-wide query as get_cpu_maxima_gcp with a 5-minute
+    alignment period.
+    """
+    series = {}
+    for instance_id, point in _list_cpu_points(project_id, instance_ids, account, start, end, 300):
+        series.setdefault(instance_id, []).append(point.value.double_value * 100.0)
+
+    if instance_ids is None:
+        return series
+    return {str(instance_id): series.get(str(instance_id), []) for instance_id in instance_ids}
+
+def get_cpu_buckets_gcp(project_id, instance_ids=None, account=None, start=None, end=None):
+    """Return (period start, maximum) of each METRICS_BUCKET_SECONDS period per instance.
+
+    Period starts are epoch seconds and maxima are 0.0-1.0, as in
+    get_cpu_maxima_gcp, whose query this uses with METRICS_BUCKET_SECONDS alignment.
+    """
+    buckets = {}
+    for instance_id, point in _list_cpu_points(project_id, instance_ids, account, start, end,
+                                               METRICS_BUCKET_SECONDS):
+        # Aligned points are stamped with the end of their alignment period
+        period_start = point.interval.end_time.timestamp() - METRICS_BUCKET_SECONDS
+        buckets.setdefault(instance_id, []).append((period_start, point.value.double_value))
+
+    if instance_ids is None:
+        return buckets
+    return {str(instance_id): buckets.get(str(instance_id), []) for instance_id in instance_ids}
+
+def _list_cpu_points(project_id, instance_ids, account, start, end, alignment_seconds):
+    """Yield (instance_id, point) for every aligned CPU point; the whole range is one
+    alignment period when alignment_seconds is None."""
+    from google.cloud import monitoring_v3
+
+    if instance_ids is not None and not instance_ids:
+        return
+
+    now = end.timestamp() if end else time.time()
+    window_start = start.timestamp() if start else now - CPU_CHECK_DAYS * 24 * 3600
+    # Alignment periods must be at least 60 seconds
+    window_seconds = max(int(now - window_start), 60)
+    interval = monitoring_v3.TimeInterval({
+        "end_time": {"seconds": int(now)},
+        "start_time": {"seconds": int(now) - window_seconds},
+    })
+
+    cpu_filter = 'metric.type="compute.googleapis.com/instance/cpu/utilization"'
+    if instance_ids is not None and len(instance_ids) <= FILTER_MAX_INSTANCE_IDS:
+        # Small batches are filtered server-side, larger sets query the whole project
+        quoted_ids = ", ".join(f'"{instance_id}"' for instance_id in instance_ids)
+        cpu_filter += f' AND resource.labels.instance_id = one_of({quoted_ids})'
+
+    pages = iter_gcp_pages(
+        'metrics',
+        get_gcp_monitoring_client(account).list_time_series,
+        {
+            "name": f"projects/{project_id}",
+            "filter": cpu_filter,
+            "interval": interval,
+            "view": monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
+            "aggregation": {
+                "alignment_period": {"seconds": alignment_seconds or window_seconds},
+                "per_series_aligner": monitoring_v3.Aggregation.Aligner.ALIGN_MAX,
+                "cross_series_reducer": monitoring_v3.Aggregation.Reducer.REDUCE_MAX,
+                "group_by_fields": ["resource.labels.instance_id"],
             }
-        )
+        }
+    )
 
-        points = [p for r in results for p in r.points]
-        if not points or all(p.value.double_value < GCP_CPU_THRESHOLD / 100.0 for p in points):
-            logger.info(f"Instance {instance_id} has low CPU usage for the last {CPU_CHECK_DAYS} days.")
-            return True
+    # Pages are fetched one at a time while iterating
+    for page in pages:
+        for series in page.time_series:
+            instance_id = series.resource.labels.get("instance_id")
+            for point in series.points:
+                yield instance_id, point
 
-        return False
+def is_low_cpu_gcp(instance_id, cpu_max):
+    """Apply GCP_CPU_THRESHOLD to the maximum CPU utilization (0.0-1.0) of an instance."""
+    if cpu_max is None or cpu_max < GCP_CPU_THRESHOLD / 100.0:
+        logger.debug(f"Instance {instance_id} has low CPU usage for the last {CPU_CHECK_DAYS} days.")
+        return True
+
+    logger.debug(f"Instance {instance_id} exceeds CPU threshold with usage: {cpu_max * 100.0}")
+    return False
+
+def has_low_usage_gcp(project_id, instance_id, zone, compute_client, instance=None):
+    logger.info(f"Checking low usage for GCP instance: {instance_id} in zone: {zone}")
+    try:
+        if instance is None:
+            instance = VMRecord('gcp', str(instance_id), location=zone, project=project_id)
+        if not is_gcp_candidate(instance, compute_client):
+            return False
+
+        # Get CPU metrics for the last 2 days
+        maxima = get_cpu_maxima_gcp(project_id, [str(instance_id)])
+        return is_low_cpu_gcp(instance_id, maxima[str(instance_id)])
 
     except Exception as e:
         logger.error(f"Error in has_low_usage_gcp: {e}")
@@ -0,0 +1,176 @@
+from datetime import datetime
+import logging
+from config import REQUIRED_TAGS, VM_AGE_DAYS
+from ratelimit import call_api, iter_gcp_pages, iter_azure_pages
+from records import VMRecord
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Inventory snapshots capture everything the evaluators need from the paginated
+# list calls, so no VM has to be described again to read its tags or age. The
+# iter_* generators yield records page by page as they arrive.
+# Each record is a records.VMRecord with id, name, location, tags, created and
+# state set; GCP records additionally carry the project and Azure records the
+# subscription (as project) and resource_group. The state is the instance state
+# on AWS, the status on GCP and the power state code on Azure.
+#
+# With prefilter=True the REQUIRED_TAGS and running-state predicates are pushed to
+# the provider, so only candidate VMs are listed at all. Azure additionally
+# filters on age through Resource Graph; AWS and GCP cannot filter on launch or
+# creation time server-side, so age is still checked from the snapshot.
+#
+# Every page request goes through the provider's 'list' (or AWS 'describe') rate
+# limiter, so a throttled page is retried instead of aborting the listing.
+
+def parse_timestamp(timestamp):
+    if not timestamp:
+        return None
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+def azure_power_state(vm):
+    """Return the 'PowerState/...' code of a VM fetched with its instance view."""
+    statuses = vm.instance_view.statuses if vm.instance_view else []
+    return next((status.code for status in statuses if status.code.startswith('PowerState/')), None)
+
+def discover_aws_regions(ec2_client):
+    """Return the names of all regions enabled for the account."""
+    response = call_api('aws', 'describe', ec2_client.describe_regions,
+        Filters=[{'Name': 'opt-in-status', 'Values': ['opt-in-not-required', 'opted-in']}]
+    )
+    regions = sorted(region['RegionName'] for region in response['Regions'])
+    logger.info(f"Discovered {len(regions)} AWS regions")
+    return regions
+
+def iter_aws_instances(ec2_client, prefilter=False):
+    logger.info("Building AWS inventory snapshot")
+    count = 0
+    filters = []
+    if prefilter:
+        filters = [{'Name': f"tag:{key}", 'Values': [value]} for key, value in REQUIRED_TAGS.items()]
+        filters.append({'Name': 'instance-state-name', 'Values': ['running']})
+    request = {'Filters': filters}
+    while True:
+        page = call_api('aws', 'describe', ec2_client.describe_instances, **request)
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                count += 1
+                yield VMRecord(
+                    'aws', instance['InstanceId'],
+                    location=instance.get('Placement', {}).get('AvailabilityZone'),
+                    tags={tag['Key']: tag['Value'] for tag in instance.get('Tags', [])},
+                    created=instance.get('LaunchTime'),
+                    state=instance.get('State', {}).get('Name'),
+                )
+        if not page.get('NextToken'):
+            break
+        request['NextToken'] = page['NextToken']
+    logger.info(f"AWS inventory snapshot contains {count} instances")
+
+def iter_gcp_instances(compute_client, project_id, prefilter=False):
+    logger.info(f"Building GCP inventory snapshot for project: {project_id}")
+    count = 0
+    request = {"project": project_id}
+    if prefilter:
+        expressions = [f'(labels.{key} = "{value}")' for key, value in REQUIRED_TAGS.items()]
+        expressions.append('(status = "RUNNING")')
+        request["filter"] = " AND ".join(expressions)
+    for page in iter_gcp_pages('list', compute_client.aggregated_list, request):
+        for zone_key, scoped_list in page.items.items():
+            zone = zone_key.split("/")[-1]
+            instances = scoped_list.instances if scoped_list.instances else []
+            for instance in instances:
+                count += 1
+                yield VMRecord(
+                    'gcp', str(instance.id), instance.name,
+                    location=zone,
+                    project=project_id,
+                    tags=dict(instance.labels) if instance.labels else {},
+                    created=parse_timestamp(instance.creation_timestamp),
+                    state=instance.status,
+                )
+    logger.info(f"GCP inventory snapshot contains {count} instances")
+
+def iter_azure_vms(compute_client):
+    logger.info("Building Azure inventory snapshot")
+    count = 0
+    # status_only adds the instance view, which holds the power state
+    for vm in iter_azure_pages('list', compute_client.virtual_machines.list_all(status_only='true')):
+        count += 1
+        yield VMRecord.from_azure_id(
+            vm.id,
+            location=vm.location,
+            tags=dict(vm.tags) if vm.tags else {},
+            created=vm.time_created,
+            state=azure_power_state(vm),
+        )
+    logger.info(f"Azure inventory snapshot contains {count} VMs")
+
+def iter_azure_graph_vms(resource_graph_client, subscription_id):
+    """List candidate Azure VMs through a Resource Graph query.
+
+    Tags, age and power state are all evaluated by Resource Graph, and results
+    are paged with skip tokens.
+    """
+    from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions
+
+    logger.info(f"Building Azure inventory snapshot from Resource Graph for subscription: {subscription_id}")
+    tag_conditions = " and ".join(f"tags['{key}'] == '{value}'" for key, value in REQUIRED_TAGS.items())
+    query = (
+        "Resources"
+        " | where type =~ 'microsoft.compute/virtualmachines'"
+        f" | where {tag_conditions}"
+        f" | where todatetime(properties.timeCreated) <= ago({VM_AGE_DAYS}d)"
+        " | where properties.extended.instanceView.powerState.code =~ 'PowerState/running'"
+        " | project id, name, location, resourceGroup, tags,"
+        " timeCreated = tostring(properties.timeCreated),"
+        " state = tostring(properties.extended.instanceView.powerState.code)"
+    )
+    count = 0
+    skip_token = None
+    while True:
+        response = call_api('azure', 'list', resource_graph_client.resources, QueryRequest(
+            subscriptions=[subscription_id],
+            query=query,
+            options=QueryRequestOptions(skip_token=skip_token, result_format='objectArray'),
+        ))
+        for row in response.data:
+            count += 1
+            yield VMRecord.from_azure_id(
+                row['id'],
+                location=row['location'],
+                tags=row.get('tags') or {},
+                created=parse_timestamp(row.get('timeCreated')),
+                state=row.get('state'),
+            )
+        skip_token = response.skip_token
+        if not skip_token:
+            break
+    logger.info(f"Azure inventory snapshot contains {count} VMs")
+
+def describe_vm(client, record):
+    """Fetch the tags, creation time, location and state of one VM into record.
+
+    client is the provider's EC2, InstancesClient or ComputeManagementClient.
+    """
+    if record.provider == 'aws':
+        response = call_api('aws', 'describe', client.describe_instances, InstanceIds=[record.id])
+        instance = response['Reservations'][0]['Instances'][0]
+        record.tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+        record.created = instance.get('LaunchTime')
+        record.location = instance.get('Placement', {}).get('AvailabilityZone')
+        record.state = instance.get('State', {}).get('Name')
+    elif record.provider == 'gcp':
+        instance = call_api('gcp', 'list', client.get, project=record.project, zone=record.location,
+                            instance=record.name)
+        record.tags = dict(instance.labels) if instance.labels else {}
+        record.created = parse_timestamp(instance.creation_timestamp)
+        record.state = instance.status
+    else:
+        vm = call_api('azure', 'list', client.virtual_machines.get, record.resource_group, record.name,
+                      expand='instanceView')
+        record.tags = dict(vm.tags) if vm.tags else {}
+        record.created = vm.time_created
+        record.location = vm.location
+        record.state = azure_power_state(vm)
+    return record
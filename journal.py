@@ -0,0 +1,98 @@
+import time
+import logging
+from storage import SQLiteStore
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Outcomes that need no further work when a run is resumed. "deleting" VMs are
+# re-attached to their pending operation instead, and "failed" ones are evaluated again.
+FINISHED_STATUSES = ("kept", "deleted")
+
+class RunJournal(SQLiteStore):
+    """On-disk journal of the per-VM outcomes of each run, so an interrupted run can be resumed.
+
+    A run is started with begin_run(). While it runs, every evaluated candidate is
+    recorded as "kept" once its CPU data shows it busy, and every delete as
+    "deleting" (with the provider operation id) once it is submitted, then as
+    "deleted" or "failed" when it completes. Resuming continues the latest
+    unfinished run: finished VMs are skipped and pending deletes are re-attached
+    rather than submitted again. Shards in other processes may write to the same
+    file and run. finish_run() removes the VM rows of the run, so the journal
+    only grows with the runs still unfinished.
+    """
+
+    def __init__(self, path, run_id=None):
+        super().__init__(path)
+        self.run_id = run_id
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "run_id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL NOT NULL, finished REAL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS vms ("
+                "run_id INTEGER NOT NULL, provider TEXT NOT NULL, vm_id TEXT NOT NULL, name TEXT, "
+                "status TEXT NOT NULL, operation TEXT, message TEXT, updated REAL NOT NULL, "
+                "PRIMARY KEY (run_id, provider, vm_id))"
+            )
+
+    def begin_run(self, resume=False):
+        """Start a new run, or continue the latest unfinished one when resume is set."""
+        with self._lock, self._conn:
+            if resume:
+                row = self._conn.execute(
+                    "SELECT run_id FROM runs WHERE finished IS NULL ORDER BY run_id DESC LIMIT 1"
+                ).fetchone()
+                if row:
+                    self.run_id = row[0]
+                    logger.info(f"Resuming run {self.run_id}")
+                    return self.run_id
+                logger.info("No unfinished run to resume, starting a new run")
+            self.run_id = self._conn.execute("INSERT INTO runs (started) VALUES (?)", (time.time(),)).lastrowid
+        logger.info(f"Started run {self.run_id}")
+        return self.run_id
+
+    def finish_run(self):
+        """Mark the run finished and drop the VM rows of finished runs, which can no longer be resumed."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (time.time(), self.run_id))
+            removed = self._conn.execute(
+                "DELETE FROM vms WHERE run_id IN (SELECT run_id FROM runs WHERE finished IS NOT NULL)"
+            ).rowcount
+        logger.info(f"Finished run {self.run_id}, removed {removed} journaled VM outcomes")
+
+    def record(self, provider, entries):
+        """Store (vm_id, name, status, operation, message) tuples for provider.
+
+        A None name or operation keeps the value recorded earlier for the VM.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO vms (run_id, provider, vm_id, name, status, operation, message, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (run_id, provider, vm_id) DO UPDATE SET "
+                "name = COALESCE(excluded.name, name), status = excluded.status, "
+                "operation = COALESCE(excluded.operation, operation), message = excluded.message, "
+                "updated = excluded.updated",
+                [(self.run_id, provider, vm_id, name, status, operation, message, now)
+                 for vm_id, name, status, operation, message in entries],
+            )
+
+    def settled_ids(self, provider):
+        """Return the ids of the VMs a resumed run must not evaluate again."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT vm_id FROM vms WHERE run_id = ? AND provider = ? AND status IN (?, ?, ?)",
+                (self.run_id, provider, *FINISHED_STATUSES, "deleting"),
+            )
+            return {row[0] for row in rows}
+
+    def pending_deletes(self, provider):
+        """Return (vm_id, name, operation) for every delete submitted but not completed."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT vm_id, name, operation FROM vms WHERE run_id = ? AND provider = ? AND status = 'deleting'",
+                (self.run_id, provider),
+            ).fetchall()
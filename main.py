@@ -3,7 +3,13 @@ import json
 import argparse
 from datetime import datetime
 from controller import FallbackController
-from config import GCP_CREDS_PATH
+from sharding import load_shards, run_sharded
+from journal import RunJournal
+from daemon import FallbackDaemon
+from utils import summarize_results
+from providers import CLOUDS, parse_clouds
+from telemetry import telemetry
+from config import GCP_CREDS_PATH, SHARD_WORKERS, RUN_JOURNAL_PATH, RUN_METRICS_PATH
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,19 +27,32 @@ def get_gcp_project_id():
         creds = json.load(f)
         return creds.get("project_id")
 
-# def parse_args():
-#     parser = argparse.ArgumentParser(description="Run VM fallback detection across clouds")
-#     return parser.parse_args()
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run VM fallback detection across clouds")
+    parser.add_argument("--clouds", type=parse_clouds, default=CLOUDS,
+                        help="Comma-separated clouds to scan, e.g. aws,gcp (default: all); "
+                             "the SDKs and credentials of other clouds are not loaded")
+    parser.add_argument("--shards", help="JSON file listing AWS accounts, GCP projects and Azure "
+                                         "subscriptions to scan, one worker process per entry")
+    parser.add_argument("--shard-workers", type=int, help="Maximum number of shard worker processes")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the latest interrupted run: skip VMs it already handled and "
+                             "wait for its pending deletes instead of submitting them again")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep running, refreshing the inventory periodically and evaluating each VM "
+                             "only when it can next qualify for removal")
+    parser.add_argument("--metrics-out", default=RUN_METRICS_PATH,
+                        help="Where to write the run's phase timings and API call counters: a Prometheus "
+                             "textfile, or JSON for a .json path (default: RUN_METRICS_PATH)")
+    return parser.parse_args()
 
 def format_results(results):
-    summary = {k: {"success": 0, "failed": 0, "total": 0} for k in results}
+    summary = summarize_results(results)
     for cloud, vms in results.items():
         print(f"\n{cloud.upper()} Results:")
         for vm_id, success, msg in vms:
             status = "SUCCESS" if success else "FAILED"
             print(f"{vm_id}: {status} - {msg}")
-            summary[cloud]["total"] += 1
-            summary[cloud]["success" if success else "failed"] += 1
     print("\nSummary:")
     for cloud, stats in summary.items():
         print(f"{cloud.upper()}: Total={stats['total']}, Success={stats['success']}, Failed={stats['failed']}")
@@ -41,15 +60,43 @@ def format_results(results):
 def main():
     try:
         logger.info("Parsing arguments")
-        # args = parse_args()
+        args = parse_args()
         logger.info("Starting fallback detection")
 
-        project_id = get_gcp_project_id()
-        logger.info(f"Using GCP project ID: {project_id}")
+        if args.daemon:
+            if args.shards or args.resume:
+                raise ValueError("--daemon cannot be combined with --shards or --resume")
+            project_id = get_gcp_project_id() if "gcp" in args.clouds else None
+            logger.info(f"Using GCP project ID: {project_id}")
+            daemon = FallbackDaemon(FallbackController(clouds=args.clouds), project_id,
+                                    metrics_path=args.metrics_out)
+            try:
+                daemon.run()
+            except KeyboardInterrupt:
+                logger.info("Daemon stopped")
+            return
 
-        controller = FallbackController()
-        results = controller.execute_fallback(project_id)
+        journal = RunJournal(RUN_JOURNAL_PATH) if RUN_JOURNAL_PATH else None
+        if args.resume and journal is None:
+            raise ValueError("--resume needs a run journal, but RUN_JOURNAL_PATH is empty")
+        run_id = journal.begin_run(args.resume) if journal else None
 
+        if args.shards:
+            shards = [shard for shard in load_shards(args.shards) if shard['cloud'] in args.clouds]
+            logger.info(f"Running {len(shards)} shards from: {args.shards}")
+            results = run_sharded(shards, args.shard_workers or SHARD_WORKERS, run_id)
+        else:
+            project_id = get_gcp_project_id() if "gcp" in args.clouds else None
+            logger.info(f"Using GCP project ID: {project_id}")
+
+            controller = FallbackController(clouds=args.clouds, run_id=run_id)
+            results = controller.execute_fallback(project_id)
+
+        if journal:
+            journal.finish_run()
+            journal.close()
+        if args.metrics_out:
+            telemetry.export(args.metrics_out)
         format_results(results)
         logger.info("Fallback detection completed")
 
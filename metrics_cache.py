@@ -0,0 +1,122 @@
+import math
+import logging
+from storage import SQLiteStore
+from config import CPU_CHECK_DAYS, METRICS_SETTLE_SECONDS, METRICS_BUCKET_SECONDS
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class MetricsCache(SQLiteStore):
+    """On-disk cache of per-VM CPU maxima, so repeated runs only fetch new data.
+
+    Maxima are kept per VM and time bucket of bucket_seconds. Every fetch stores
+    the maxima of the periods it returned, each in the bucket its period starts
+    in or, for a period that straddles a bucket boundary, the next one, so a
+    bucket b only holds samples taken within bucket_seconds of b. Refetched
+    buckets keep the larger maximum. The VM's high-water mark advances to the end
+    of the fetched range minus METRICS_SETTLE_SECONDS (monitoring backends publish
+    datapoints late, so the most recent minutes are fetched again next time). The
+    window maximum is the maximum of every bucket that may hold a sample from the
+    CPU_CHECK_DAYS window; a bucket at the start of the window may also hold an
+    older peak, which only ever makes a VM look busier, never idle. Buckets and
+    marks that fall out of the window are evicted. Timestamps are epoch seconds.
+    """
+
+    # Version 1 kept one maximum per fetched range, which its marks refer to
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path, window_seconds=CPU_CHECK_DAYS * 24 * 3600, bucket_seconds=METRICS_BUCKET_SECONDS):
+        super().__init__(path)
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        with self._conn:
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS cpu_maxima")
+                self._conn.execute("DROP TABLE IF EXISTS high_water")
+                self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cpu_buckets ("
+                "provider TEXT NOT NULL, vm_id TEXT NOT NULL, bucket REAL NOT NULL, maximum REAL NOT NULL, "
+                "PRIMARY KEY (provider, vm_id, bucket))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cpu_buckets_age ON cpu_buckets (bucket)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS high_water ("
+                "provider TEXT NOT NULL, vm_id TEXT NOT NULL, fetched_until REAL NOT NULL, "
+                "PRIMARY KEY (provider, vm_id))"
+            )
+
+    def plan(self, provider, vm_ids, now):
+        """Group VMs by the start of the range that still has to be fetched.
+
+        Starts are rounded down to a bucket boundary, so VMs fetched at slightly
+        different times share one fetch and every fetched period falls into a
+        single bucket.
+        """
+        window_start = now - self.window_seconds
+        with self._lock:
+            marks = dict(self._conn.execute(
+                "SELECT vm_id, fetched_until FROM high_water WHERE provider = ?", (provider,)
+            ))
+        ranges = {}
+        for vm_id in vm_ids:
+            start = max(marks.get(vm_id, window_start), window_start)
+            start -= start % self.bucket_seconds
+            ranges.setdefault(start, []).append(vm_id)
+        return ranges
+
+    def store(self, provider, buckets, start, end):
+        """Store {vm_id: [(period_start, maximum), ...]} fetched for the range from start to end."""
+        fetched_until = max(end - METRICS_SETTLE_SECONDS, start)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO cpu_buckets (provider, vm_id, bucket, maximum) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (provider, vm_id, bucket) DO UPDATE SET maximum = MAX(maximum, excluded.maximum)",
+                [(provider, vm_id, self._bucket_of(period_start), maximum)
+                 for vm_id, periods in buckets.items() for period_start, maximum in periods
+                 if maximum is not None],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO high_water (provider, vm_id, fetched_until) VALUES (?, ?, ?)",
+                [(provider, vm_id, fetched_until) for vm_id in buckets],
+            )
+
+    def _bucket_of(self, period_start):
+        return math.ceil(period_start / self.bucket_seconds) * self.bucket_seconds
+
+    def _first_bucket(self, now):
+        # A bucket b holds samples up to bucket_seconds after b
+        return now - self.window_seconds - self.bucket_seconds
+
+    def window_maxima(self, provider, vm_ids, now):
+        """Return the maximum over the window for every VM, None when there is no data."""
+        with self._lock:
+            rows = dict(self._conn.execute(
+                "SELECT vm_id, MAX(maximum) FROM cpu_buckets WHERE provider = ? AND bucket > ? GROUP BY vm_id",
+                (provider, self._first_bucket(now)),
+            ))
+        return {vm_id: rows.get(vm_id) for vm_id in vm_ids}
+
+    def busy_until(self, provider, vm_ids, threshold, now):
+        """Return when the latest cached sample above threshold of each VM leaves the window.
+
+        Until then the window maximum of the VM stays above threshold, so it cannot
+        turn idle earlier. VMs without such a sample are left out.
+        """
+        with self._lock:
+            rows = dict(self._conn.execute(
+                "SELECT vm_id, MAX(bucket) FROM cpu_buckets WHERE provider = ? AND bucket > ? AND maximum > ? "
+                "GROUP BY vm_id",
+                (provider, self._first_bucket(now), threshold),
+            ))
+        return {vm_id: rows[vm_id] + self.bucket_seconds + self.window_seconds
+                for vm_id in vm_ids if vm_id in rows}
+
+    def evict(self, now):
+        with self._lock, self._conn:
+            removed = self._conn.execute(
+                "DELETE FROM cpu_buckets WHERE bucket <= ?", (self._first_bucket(now),)
+            ).rowcount
+            self._conn.execute("DELETE FROM high_water WHERE fetched_until <= ?", (now - self.window_seconds,))
+        if removed:
+            logger.info(f"Evicted {removed} cached CPU maxima older than {CPU_CHECK_DAYS} days")
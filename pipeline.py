@@ -0,0 +1,102 @@
+import queue
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import PIPELINE_QUEUE_SIZE
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+def run_pipeline(source, stages, queue_size=PIPELINE_QUEUE_SIZE):
+    """Stream the items of source through stages and yield what the last stage produces.
+
+    Every stage is a function that takes an iterable and returns an iterable (usually
+    a generator). The source and each stage run in their own thread, connected by
+    queues of at most queue_size items, so a slow stage holds back the ones before
+    it instead of letting items pile up in memory. An exception in any stage is
+    passed downstream and re-raised here; the remaining threads then stop.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def drain(q):
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def pump(make_iterable, q):
+        try:
+            for item in make_iterable():
+                if stop.is_set():
+                    return
+                put(q, item)
+            put(q, _DONE)
+        except BaseException as e:
+            put(q, _Failure(e))
+
+    producers = [lambda: source]
+    for index, stage in enumerate(stages):
+        producers.append(lambda stage=stage, upstream=queues[index]: stage(drain(upstream)))
+
+    threads = [threading.Thread(target=pump, args=(producer, q), daemon=True)
+               for producer, q in zip(producers, queues)]
+    for thread in threads:
+        thread.start()
+    try:
+        yield from drain(queues[-1])
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def batched(items, size):
+    """Group a stream of items into lists of at most size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def imap_bounded(func, items, max_workers):
+    """Like map(), but runs up to max_workers calls at once while items keep streaming in.
+
+    Results are yielded in input order.
+    """
+    if max_workers <= 1:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,74 @@
+import logging
+import numpy as np
+from config import (CPU_POLICY, CPU_POLICY_PERCENTILE, CPU_POLICY_IDLE_HOURS, CPU_POLICY_IDLE_SHARE,
+                    POLICY_CHUNK_ROWS)
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# CPU series are sampled every 5 minutes
+SAMPLES_PER_HOUR = 12
+
+POLICIES = ("max", "percentile", "idle_hours", "idle_share")
+
+def load_series(series_list):
+    """Pack a list of CPU series into a NaN-padded float32 matrix, one row per VM."""
+    lengths = np.fromiter((len(series) for series in series_list), dtype=np.int64, count=len(series_list))
+    width = int(lengths.max()) if len(lengths) else 0
+    matrix = np.full((len(series_list), width), np.nan, dtype=np.float32)
+    if width:
+        values = np.fromiter((value for series in series_list for value in series), dtype=np.float32,
+                             count=int(lengths.sum()))
+        matrix[np.arange(width) < lengths[:, None]] = values
+    return matrix
+
+def longest_idle_run(idle):
+    """Return the longest run of consecutive True samples in every row of a boolean matrix."""
+    counts = np.cumsum(idle, axis=1)
+    # Count reached at the last busy sample, carried forward until the next busy sample
+    resets = np.maximum.accumulate(np.where(idle, 0, counts), axis=1)
+    runs = counts - resets
+    return runs.max(axis=1) if runs.shape[1] else np.zeros(len(runs), dtype=np.int64)
+
+def evaluate_matrix(matrix, threshold, policy=CPU_POLICY):
+    """Return a boolean array telling which rows of a series matrix are idle under policy.
+
+    Rows without any sample are idle, matching the single-threshold check.
+    """
+    has_data = ~np.all(np.isnan(matrix), axis=1)
+    idle = np.ones(len(matrix), dtype=bool)
+    if not has_data.any():
+        return idle
+    data = matrix[has_data]
+    below = data <= threshold  # NaN padding compares False
+
+    if policy == "max":
+        idle[has_data] = np.nanmax(data, axis=1) <= threshold
+    elif policy == "percentile":
+        idle[has_data] = np.nanpercentile(data, CPU_POLICY_PERCENTILE, axis=1) <= threshold
+    elif policy == "idle_hours":
+        idle[has_data] = longest_idle_run(below) >= CPU_POLICY_IDLE_HOURS * SAMPLES_PER_HOUR
+    elif policy == "idle_share":
+        samples = np.sum(~np.isnan(data), axis=1)
+        idle[has_data] = np.sum(below, axis=1) / samples >= CPU_POLICY_IDLE_SHARE
+    else:
+        raise ValueError(f"Unknown CPU policy: {policy}")
+    return idle
+
+def evaluate_policy(series_by_id, threshold, policy=CPU_POLICY):
+    """Evaluate policy over the CPU series of many VMs at once.
+
+    series_by_id maps a VM id to its CPU samples in percent. VMs are processed in
+    chunks of POLICY_CHUNK_ROWS so memory stays bounded for very large fleets.
+    Returns a dict mapping every VM id to True when the VM is idle.
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown CPU policy: {policy}")
+    vm_ids = list(series_by_id)
+    idle = {}
+    for offset in range(0, len(vm_ids), POLICY_CHUNK_ROWS):
+        chunk = vm_ids[offset:offset + POLICY_CHUNK_ROWS]
+        matrix = load_series([series_by_id[vm_id] for vm_id in chunk])
+        idle.update(zip(chunk, evaluate_matrix(matrix, threshold, policy).tolist()))
+    logger.info(f"CPU policy '{policy}' marked {sum(idle.values())} of {len(idle)} VMs as idle")
+    return idle
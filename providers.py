@@ -0,0 +1,26 @@
+import importlib
+
+# Provider plugins by cloud. A plugin module holds the candidate, metrics and
+# decision functions of one cloud and is imported only when that cloud is
+# selected; the SDK itself is imported when the first client is created (see
+# auth.ClientRegistry), so unused clouds cost nothing at startup.
+PROVIDER_MODULES = {
+    "aws": "aws_fallback",
+    "gcp": "gcp_fallback",
+    "azure": "azure_fallback",
+}
+
+CLOUDS = tuple(PROVIDER_MODULES)
+
+def load_provider(cloud):
+    if cloud not in PROVIDER_MODULES:
+        raise ValueError(f"Unknown cloud: {cloud}")
+    return importlib.import_module(PROVIDER_MODULES[cloud])
+
+def parse_clouds(value):
+    """Parse a comma-separated list of clouds such as "aws,gcp"."""
+    clouds = tuple(dict.fromkeys(cloud.strip().lower() for cloud in value.split(',') if cloud.strip()))
+    unknown = [cloud for cloud in clouds if cloud not in PROVIDER_MODULES]
+    if unknown or not clouds:
+        raise ValueError(f"Invalid clouds '{value}', choose from: {', '.join(CLOUDS)}")
+    return clouds
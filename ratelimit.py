@@ -0,0 +1,183 @@
+import random
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from telemetry import telemetry
+from config import (API_RATE_LIMITS, DEFAULT_API_RATE_LIMIT, API_MAX_CONCURRENCY, RATE_LIMIT_INCREASE_AFTER,
+                    RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS)
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Error codes AWS uses for throttled requests
+AWS_THROTTLING_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'RequestLimitExceeded', 'TooManyRequestsException',
+    'SlowDown', 'PriorRequestNotComplete',
+}
+
+class AdaptiveLimiter:
+    """Token bucket plus AIMD concurrency limit for one provider API.
+
+    Requests are started at no more than rate per second, in bursts of up to
+    max(rate, 1) requests. At most `limit` of them are in flight at once; the
+    limit is halved on every throttling response and raised by one after
+    RATE_LIMIT_INCREASE_AFTER consecutive successes, up to max_concurrency.
+    """
+
+    def __init__(self, rate, max_concurrency=API_MAX_CONCURRENCY):
+        self.rate = float(rate)
+        # A bucket smaller than one token could never start a request
+        self.burst = max(self.rate, 1.0)
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        self._successes = 0
+        self._blocked_until = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+                self._refilled_at = now
+                wait = self._blocked_until - now
+                if wait <= 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                if wait <= 0:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self, throttled=False, retry_after=None):
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self._successes = 0
+                self.limit = max(1, self.limit // 2)
+                if retry_after:
+                    # Every caller of this API waits until the provider allows requests again
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            else:
+                self._successes += 1
+                if self._successes >= RATE_LIMIT_INCREASE_AFTER and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(provider, api):
+    with _limiters_lock:
+        limiter = _limiters.get((provider, api))
+        if limiter is None:
+            limiter = AdaptiveLimiter(API_RATE_LIMITS.get((provider, api), DEFAULT_API_RATE_LIMIT))
+            _limiters[(provider, api)] = limiter
+        return limiter
+
+def parse_retry_after(value):
+    """Return the delay in seconds from a Retry-After header (seconds or HTTP date)."""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def classify_error(error):
+    """Return (throttled, retry_after) for an exception raised by any provider SDK.
+
+    The SDK exception types are duck-typed so this module does not import them:
+    botocore ClientError carries a response dict, google.api_core errors a code,
+    and azure.core HttpResponseError a status_code and response headers.
+    """
+    response = getattr(error, 'response', None)
+
+    # AWS
+    if isinstance(response, dict) and 'Error' in response:
+        code = response['Error'].get('Code')
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        return code in AWS_THROTTLING_CODES, parse_retry_after(headers.get('retry-after'))
+
+    status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    if status == 429 or getattr(status, 'value', None) == 429:
+        headers = getattr(response, 'headers', None) or {}
+        return True, parse_retry_after(headers.get('Retry-After') or headers.get('retry-after'))
+
+    # gRPC RESOURCE_EXHAUSTED from google.api_core
+    if getattr(error, 'grpc_status_code', None) is not None and getattr(error.grpc_status_code, 'name', None) == 'RESOURCE_EXHAUSTED':
+        return True, None
+    return False, None
+
+def call_api(provider, api, func, *args, **kwargs):
+    """Call func through the limiter of (provider, api), retrying throttled requests.
+
+    A throttled call is retried up to RETRY_MAX_ATTEMPTS times, after the
+    provider's Retry-After delay when it sends one and after exponential backoff
+    with jitter otherwise. Any other error is raised immediately. Every attempt is
+    counted in telemetry under the name of func.
+    """
+    limiter = get_limiter(provider, api)
+    endpoint = getattr(func, '__name__', api)
+    for attempt in range(1, RETRY_MAX_ATTEMPTS + 1):
+        limiter.acquire()
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            throttled, retry_after = classify_error(e)
+            limiter.release(throttled, retry_after)
+            telemetry.record_call(provider, api, endpoint, time.perf_counter() - started, True, throttled)
+            if not throttled or attempt == RETRY_MAX_ATTEMPTS:
+                raise
+            telemetry.record_retry(provider, api, endpoint)
+            delay = retry_after
+            if delay is None:
+                delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1))
+                delay = random.uniform(delay / 2, delay)
+            logger.warning(f"{provider.upper()} {api} call throttled (attempt {attempt}/{RETRY_MAX_ATTEMPTS}), "
+                           f"retrying in {delay:.1f}s; concurrency limit is now {limiter.limit}")
+            time.sleep(delay)
+            continue
+        limiter.release()
+        telemetry.record_call(provider, api, endpoint, time.perf_counter() - started)
+        return result
+
+def iter_gcp_pages(api, method, request):
+    """Yield the pages of a paginated GCP list call, rate limiting every page request."""
+    page_token = ""
+    while True:
+        pager = call_api('gcp', api, method, request=dict(request, page_token=page_token))
+        # Building the pager already fetched the first page
+        page = next(iter(pager.pages))
+        yield page
+        page_token = page.next_page_token
+        if not page_token:
+            return
+
+def iter_azure_pages(api, item_paged):
+    """Yield the items of an Azure ItemPaged, rate limiting every page request."""
+    pages = item_paged.by_page()
+
+    def list_page():
+        return next(pages, None)
+
+    while True:
+        page = call_api('azure', api, list_page)
+        if page is None:
+            return
+        yield from page
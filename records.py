@@ -0,0 +1,114 @@
+import math
+from array import array
+from datetime import datetime, timezone
+
+class VMRecord:
+    """One VM as listed by its provider.
+
+    Built once from the listing and passed through the whole pipeline, so no
+    provider response or resource ID has to be parsed again. location is the
+    availability zone (AWS, GCP) or region (Azure); project is the GCP project or
+    Azure subscription and resource_group the Azure resource group. tags and
+    created are None when they have not been read, for example for a record built
+    from an ID alone; the candidate checks then fetch them.
+    """
+    __slots__ = ('provider', 'id', 'name', 'location', 'project', 'resource_group', 'tags', 'created', 'state')
+
+    def __init__(self, provider, id, name=None, location=None, project=None, resource_group=None, tags=None,
+                 created=None, state=None):
+        self.provider = provider
+        self.id = id
+        self.name = name or id
+        self.location = location
+        self.project = project
+        self.resource_group = resource_group
+        self.tags = tags
+        self.created = created
+        self.state = state
+
+    @classmethod
+    def from_azure_id(cls, vm_resource_id, **fields):
+        """Build an Azure record from its resource ID, which holds the subscription, group and name."""
+        parts = vm_resource_id.split('/')
+        return cls('azure', vm_resource_id, parts[8], project=parts[2], resource_group=parts[4], **fields)
+
+    def __repr__(self):
+        return f"VMRecord({self.provider!r}, {self.id!r}, name={self.name!r}, location={self.location!r})"
+
+# Fields with few distinct values across a fleet, stored as codes into a table of those values
+CODED_FIELDS = ('location', 'project', 'resource_group', 'tags', 'state')
+
+class Fleet:
+    """Column store of the VMs of one provider scope.
+
+    A VMRecord with its own tags dict and datetime costs several hundred bytes
+    per VM. A Fleet keeps one row per VM instead: ids and names in lists, creation
+    times as POSIX seconds in a float array, and the CODED_FIELDS as integer codes
+    in arrays indexing tables of their distinct values. Records are rebuilt on
+    access; their tags are copies, so callers may modify them.
+    """
+
+    def __init__(self, provider, records=()):
+        self.provider = provider
+        self.ids = []
+        # None where the name equals the id, as it does for every AWS instance
+        self.names = []
+        # NaN when the creation time is unknown
+        self.created = array('d')
+        self._rows = {}
+        self._codes = {field: array('I') for field in CODED_FIELDS}
+        self._tables = {field: [] for field in CODED_FIELDS}
+        self._table_index = {field: {} for field in CODED_FIELDS}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        """Store record, replacing the row of a VM with the same id."""
+        name = None if record.name == record.id else record.name
+        created = record.created.timestamp() if record.created is not None else math.nan
+        row = self._rows.get(record.id)
+        if row is None:
+            self._rows[record.id] = len(self.ids)
+            self.ids.append(record.id)
+            self.names.append(name)
+            self.created.append(created)
+            for field in CODED_FIELDS:
+                self._codes[field].append(self._code(field, getattr(record, field)))
+            return
+        self.names[row] = name
+        self.created[row] = created
+        for field in CODED_FIELDS:
+            self._codes[field][row] = self._code(field, getattr(record, field))
+
+    def _code(self, field, value):
+        key = tuple(sorted(value.items())) if isinstance(value, dict) else value
+        code = self._table_index[field].get(key)
+        if code is None:
+            code = len(self._tables[field])
+            self._tables[field].append(value)
+            self._table_index[field][key] = code
+        return code
+
+    def get(self, vm_id, default=None):
+        row = self._rows.get(vm_id)
+        if row is None:
+            return default
+        values = {field: self._tables[field][self._codes[field][row]] for field in CODED_FIELDS}
+        if values['tags'] is not None:
+            values['tags'] = dict(values['tags'])
+        created = self.created[row]
+        return VMRecord(self.provider, vm_id, self.names[row],
+                        created=None if math.isnan(created) else datetime.fromtimestamp(created, timezone.utc),
+                        **values)
+
+    def keys(self):
+        return self._rows.keys()
+
+    def __contains__(self, vm_id):
+        return vm_id in self._rows
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (self.get(vm_id) for vm_id in self.ids)
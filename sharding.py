@@ -0,0 +1,80 @@
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from controller import FallbackController
+from utils import summarize_results
+from providers import CLOUDS
+from telemetry import telemetry
+from config import SHARD_WORKERS
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# A shards file is a JSON list with one entry per AWS account, GCP project or
+# Azure subscription, for example:
+#   [
+#     {"cloud": "aws", "account": "/creds/aws-prod.json"},
+#     {"cloud": "gcp", "project_id": "analytics-prod"},
+#     {"cloud": "gcp", "project_id": "ml-dev", "account": "/creds/gcp-ml.json"},
+#     {"cloud": "azure", "subscription_id": "00000000-0000-0000-0000-000000000000"}
+#   ]
+# "account" is the credentials file to use and defaults to the configured one.
+
+def load_shards(shards_path):
+    with open(shards_path, 'r') as f:
+        shards = json.load(f)
+    for shard in shards:
+        if shard.get('cloud') not in CLOUDS:
+            raise ValueError(f"Invalid cloud in shard: {shard}")
+        if shard['cloud'] == "gcp" and not shard.get('project_id'):
+            raise ValueError(f"GCP shard needs a project_id: {shard}")
+    return shards
+
+def shard_name(shard):
+    cloud = shard['cloud']
+    label = shard.get('project_id') or shard.get('subscription_id') or shard.get('account') or "default"
+    return f"{cloud}:{label}"
+
+def run_shard(shard, run_id=None):
+    """Run the fallback for one shard; executed in a worker process.
+
+    Returns the results together with the shard's telemetry snapshot.
+    """
+    # Worker processes are reused, so count only this shard
+    telemetry.reset()
+    cloud = shard['cloud']
+    logger.info(f"Starting shard {shard_name(shard)}")
+    controller = FallbackController(
+        clouds=[cloud],
+        accounts={cloud: shard.get('account')},
+        azure_subscription_id=shard.get('subscription_id') if cloud == "azure" else None,
+        run_id=run_id,
+    )
+    results = controller.execute_fallback(shard.get('project_id'))
+    return results, telemetry.snapshot()
+
+def run_sharded(shards, max_workers=SHARD_WORKERS, run_id=None):
+    """Run every shard in its own process and merge the per-shard results.
+
+    The merged dict has the same shape as FallbackController.execute_fallback.
+    A shard that fails is logged and contributes no results. All shards journal
+    their outcomes under run_id when one is given, and their telemetry is merged
+    into this process.
+    """
+    merged = {"aws": [], "gcp": [], "azure": []}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_shard, shard, run_id): shard for shard in shards}
+        for future in as_completed(futures):
+            name = shard_name(futures[future])
+            try:
+                results, shard_telemetry = future.result()
+            except Exception as e:
+                logger.error(f"Shard {name} failed: {e}")
+                continue
+            for cloud, vms in results.items():
+                merged[cloud].extend(vms)
+            telemetry.merge(shard_telemetry)
+            stats = summarize_results(results)[futures[future]['cloud']]
+            logger.info(f"Shard {name} completed: Total={stats['total']}, "
+                        f"Success={stats['success']}, Failed={stats['failed']}")
+    return merged
@@ -0,0 +1,23 @@
+import os
+import sqlite3
+import threading
+
+class SQLiteStore:
+    """Base of the on-disk stores: a SQLite file shared by threads and by shard processes.
+
+    Subclasses create their tables in __init__ and run every query on self._conn
+    while holding self._lock.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        # Shards in other processes may share the file, so wait for their locks
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import threading
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the API latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Telemetry:
+    """Thread-safe counters of where a run spends its time.
+
+    Phases (list, tags, age, metrics, decision, delete) are timed per provider
+    with span() or timed_iter(). Every provider API call that goes through
+    ratelimit.call_api is counted per (provider, api, endpoint) with a latency
+    histogram, together with its errors, throttling responses and retries.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (provider, phase) -> [count, seconds]
+            self.phases = {}
+            # (provider, api, endpoint) -> {calls, errors, throttled, retries, seconds, buckets}
+            self.api_calls = {}
+
+    @contextmanager
+    def span(self, provider, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(provider, phase, time.perf_counter() - started)
+
+    def timed_iter(self, provider, phase, items):
+        """Yield from items, counting the time spent producing each item as phase."""
+        iterator = iter(items)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_phase(provider, phase, time.perf_counter() - started, 0)
+                return
+            self.add_phase(provider, phase, time.perf_counter() - started)
+            yield item
+
+    def add_phase(self, provider, phase, seconds, count=1):
+        with self._lock:
+            totals = self.phases.setdefault((provider, phase), [0, 0.0])
+            totals[0] += count
+            totals[1] += seconds
+
+    def record_call(self, provider, api, endpoint, seconds, error=False, throttled=False):
+        with self._lock:
+            stats = self._api_stats(provider, api, endpoint)
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['throttled'] += int(throttled)
+            stats['seconds'] += seconds
+            stats['buckets'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def record_retry(self, provider, api, endpoint):
+        with self._lock:
+            self._api_stats(provider, api, endpoint)['retries'] += 1
+
+    def _api_stats(self, provider, api, endpoint):
+        stats = self.api_calls.get((provider, api, endpoint))
+        if stats is None:
+            stats = {'calls': 0, 'errors': 0, 'throttled': 0, 'retries': 0, 'seconds': 0.0,
+                     'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+            self.api_calls[(provider, api, endpoint)] = stats
+        return stats
+
+    def snapshot(self):
+        """Return all counters as plain (picklable) dicts."""
+        with self._lock:
+            return {
+                'phases': {key: list(totals) for key, totals in self.phases.items()},
+                'api_calls': {key: dict(stats, buckets=list(stats['buckets']))
+                              for key, stats in self.api_calls.items()},
+            }
+
+    def merge(self, snapshot):
+        """Add the counters of a snapshot, for example one taken in a shard process."""
+        with self._lock:
+            for key, (count, seconds) in snapshot['phases'].items():
+                totals = self.phases.setdefault(key, [0, 0.0])
+                totals[0] += count
+                totals[1] += seconds
+            for key, other in snapshot['api_calls'].items():
+                stats = self._api_stats(*key)
+                for field in ('calls', 'errors', 'throttled', 'retries', 'seconds'):
+                    stats[field] += other[field]
+                stats['buckets'] = [a + b for a, b in zip(stats['buckets'], other['buckets'])]
+
+    def to_json(self):
+        snapshot = self.snapshot()
+        return {
+            'phases': [{'provider': provider, 'phase': phase, 'count': count, 'seconds': round(seconds, 6)}
+                       for (provider, phase), (count, seconds) in sorted(snapshot['phases'].items())],
+            'api_calls': [dict(stats, provider=provider, api=api, endpoint=endpoint,
+                               seconds=round(stats['seconds'], 6),
+                               buckets=dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                                                stats['buckets'])))
+                          for (provider, api, endpoint), stats in sorted(snapshot['api_calls'].items())],
+        }
+
+    def to_prometheus(self):
+        """Render the counters in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP yeedu_phase_seconds_total Time spent per provider and phase.",
+            "# TYPE yeedu_phase_seconds_total counter",
+        ]
+        for (provider, phase), (count, seconds) in sorted(snapshot['phases'].items()):
+            lines.append(f'yeedu_phase_seconds_total{{provider="{provider}",phase="{phase}"}} {seconds:.6f}')
+        lines += [
+            "# HELP yeedu_phase_items_total Items processed per provider and phase.",
+            "# TYPE yeedu_phase_items_total counter",
+        ]
+        for (provider, phase), (count, seconds) in sorted(snapshot['phases'].items()):
+            lines.append(f'yeedu_phase_items_total{{provider="{provider}",phase="{phase}"}} {count}')
+
+        counters = (
+            ('calls', 'yeedu_api_calls_total', "Provider API calls."),
+            ('errors', 'yeedu_api_errors_total', "Provider API calls that raised."),
+            ('throttled', 'yeedu_api_throttled_total', "Provider API calls rejected by throttling."),
+            ('retries', 'yeedu_api_retries_total', "Retries of throttled provider API calls."),
+        )
+        for field, name, help_text in counters:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (provider, api, endpoint), stats in sorted(snapshot['api_calls'].items()):
+                labels = f'provider="{provider}",api="{api}",endpoint="{endpoint}"'
+                lines.append(f"{name}{{{labels}}} {stats[field]}")
+
+        lines += [
+            "# HELP yeedu_api_latency_seconds Provider API call latency.",
+            "# TYPE yeedu_api_latency_seconds histogram",
+        ]
+        for (provider, api, endpoint), stats in sorted(snapshot['api_calls'].items()):
+            labels = f'provider="{provider}",api="{api}",endpoint="{endpoint}"'
+            cumulative = 0
+            for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], stats['buckets']):
+                cumulative += count
+                lines.append(f'yeedu_api_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"yeedu_api_latency_seconds_sum{{{labels}}} {stats['seconds']:.6f}")
+            lines.append(f"yeedu_api_latency_seconds_count{{{labels}}} {stats['calls']}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Write a JSON report (for a .json path) or a Prometheus textfile (otherwise)."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if path.endswith('.json'):
+            content = json.dumps(self.to_json(), indent=2)
+        else:
+            content = self.to_prometheus()
+        # Write to a temporary file first so collectors never read a partial report
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        logger.info(f"Run metrics written to: {path}")
+
+telemetry = Telemetry()
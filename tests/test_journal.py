@@ -0,0 +1,35 @@
+import pytest
+
+from journal import RunJournal
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = RunJournal(str(tmp_path / "runs.db"))
+    yield journal
+    journal.close()
+
+def test_resume_continues_the_unfinished_run(journal):
+    run_id = journal.begin_run()
+    journal.record("gcp", [("1", "vm-a", "kept", None, None), ("2", "vm-b", "deleting", "proj/zone/op", None),
+                           ("3", "vm-c", "failed", None, "boom")])
+
+    assert journal.begin_run(resume=True) == run_id
+    assert journal.settled_ids("gcp") == {"1", "2"}
+    assert journal.pending_deletes("gcp") == [("2", "vm-b", "proj/zone/op")]
+
+def test_record_keeps_earlier_name_and_operation(journal):
+    journal.begin_run()
+    journal.record("gcp", [("2", "vm-b", "deleting", "proj/zone/op", None)])
+    journal.record("gcp", [("2", None, "deleted", None, "done")])
+
+    row = journal._conn.execute("SELECT name, status, operation FROM vms").fetchone()
+    assert row == ("vm-b", "deleted", "proj/zone/op")
+
+def test_finish_run_removes_its_rows_and_resume_starts_a_new_run(journal):
+    run_id = journal.begin_run()
+    journal.record("aws", [("i-1", "i-1", "kept", None, None)])
+    journal.finish_run()
+
+    assert journal._conn.execute("SELECT COUNT(*) FROM vms").fetchone() == (0,)
+    assert journal.begin_run(resume=True) != run_id
+    assert journal.settled_ids("aws") == set()
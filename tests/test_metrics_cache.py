@@ -0,0 +1,70 @@
+import pytest
+
+from metrics_cache import MetricsCache
+
+HOUR = 3600
+DAY = 24 * HOUR
+# A bucket boundary, so the expected starts below are easy to read
+NOW = 1_800_000_000 - 1_800_000_000 % HOUR
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = MetricsCache(str(tmp_path / "metrics.db"), window_seconds=2 * DAY, bucket_seconds=HOUR)
+    yield cache
+    cache.close()
+
+def test_plan_starts_unknown_vms_at_the_window_start(cache):
+    assert cache.plan("aws", ["i-1", "i-2"], NOW + 120) == {NOW - 2 * DAY: ["i-1", "i-2"]}
+
+def test_plan_groups_vms_stored_moments_apart(cache):
+    ids = [f"i-{index}" for index in range(17)]
+    for batch in range(5):
+        fetched_at = NOW + 1800 + batch * 7.3
+        cache.store("aws", {vm_id: [(NOW, 1.0)] for vm_id in ids[batch::5]}, NOW - 2 * DAY, fetched_at)
+
+    assert cache.plan("aws", ids, NOW + 2400) == {NOW: ids}
+
+def test_plan_keeps_providers_apart(cache):
+    cache.store("aws", {"vm": [(NOW, 1.0)]}, NOW - 2 * DAY, NOW + 1800)
+    assert cache.plan("gcp", ["vm"], NOW + 1800) == {NOW - 2 * DAY: ["vm"]}
+
+def test_window_maxima_is_the_largest_bucket_and_none_without_data(cache):
+    cache.store("aws", {"i-1": [(NOW - 3 * HOUR, 40.0), (NOW - 2 * HOUR, 90.0), (NOW - HOUR, 10.0)], "i-2": []},
+                NOW - 2 * DAY, NOW)
+
+    assert cache.window_maxima("aws", ["i-1", "i-2", "i-3"], NOW) == {"i-1": 90.0, "i-2": None, "i-3": None}
+
+def test_refetched_bucket_keeps_the_larger_maximum(cache):
+    cache.store("aws", {"i-1": [(NOW - HOUR, 70.0)]}, NOW - 2 * DAY, NOW - 1800)
+    cache.store("aws", {"i-1": [(NOW - HOUR, 20.0)]}, NOW - HOUR, NOW)
+
+    assert cache.window_maxima("aws", ["i-1"], NOW) == {"i-1": 70.0}
+
+def test_peak_leaves_the_window_with_its_samples(cache):
+    # Samples of the period starting at sample_hour are taken within the next hour
+    sample_hour = NOW - 2 * DAY
+    cache.store("aws", {"i-1": [(sample_hour, 90.0), (NOW - HOUR, 5.0)]}, NOW - 2 * DAY, NOW)
+
+    gone = sample_hour + HOUR + 2 * DAY
+    assert cache.busy_until("aws", ["i-1"], 50.0, NOW) == {"i-1": gone}
+    assert cache.window_maxima("aws", ["i-1"], gone - 1) == {"i-1": 90.0}
+    assert cache.window_maxima("aws", ["i-1"], gone) == {"i-1": 5.0}
+    # A spike from the start of the first fetch no longer stays busy for two windows
+    assert cache.window_maxima("aws", ["i-1"], NOW + 2 * DAY - 1) == {"i-1": 5.0}
+
+def test_busy_until_skips_vms_below_threshold(cache):
+    cache.store("aws", {"i-1": [(NOW - HOUR, 5.0)]}, NOW - 2 * DAY, NOW)
+    assert cache.busy_until("aws", ["i-1"], 50.0, NOW) == {}
+
+def test_evict_drops_buckets_and_marks_outside_the_window(cache):
+    cache.store("aws", {"i-1": [(NOW - 2 * DAY, 90.0), (NOW - HOUR, 5.0)]}, NOW - 2 * DAY, NOW)
+    cache.store("aws", {"i-2": [(NOW - 2 * DAY, 30.0)]}, NOW - 2 * DAY, NOW - 2 * DAY + 900)
+
+    cache.evict(NOW + HOUR)
+
+    buckets = cache._conn.execute("SELECT vm_id, bucket FROM cpu_buckets ORDER BY vm_id").fetchall()
+    assert buckets == [("i-1", NOW - HOUR)]
+    marks = cache._conn.execute("SELECT vm_id FROM high_water").fetchall()
+    assert marks == [("i-1",)]
+    # i-2 lost its mark with its data, so its whole window is fetched again
+    assert cache.plan("aws", ["i-2"], NOW + HOUR) == {NOW + HOUR - 2 * DAY: ["i-2"]}
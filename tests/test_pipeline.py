@@ -0,0 +1,72 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+from pipeline import run_pipeline, batched, imap_bounded
+
+def test_run_pipeline_streams_items_through_stages_in_order():
+    def double(items):
+        return (item * 2 for item in items)
+
+    def keep_even_tens(items):
+        return (item for item in items if item % 20 == 0)
+
+    assert list(run_pipeline(range(100), [double, keep_even_tens], queue_size=3)) == list(range(0, 200, 20))
+
+def test_stage_error_propagates_and_ends_the_run():
+    consumed = []
+
+    def fail_on_five(items):
+        for item in items:
+            consumed.append(item)
+            if item == 5:
+                raise ValueError("bad item")
+            yield item
+
+    threads_before = threading.active_count()
+    # The source never ends on its own, so the run only returns if the failure stops it
+    with pytest.raises(ValueError, match="bad item"):
+        list(run_pipeline(itertools.count(), [fail_on_five, lambda items: items], queue_size=2))
+    assert consumed == [0, 1, 2, 3, 4, 5]
+    assert threading.active_count() == threads_before
+
+def test_source_error_propagates():
+    def source():
+        yield 1
+        raise RuntimeError("listing failed")
+
+    with pytest.raises(RuntimeError, match="listing failed"):
+        list(run_pipeline(source(), [lambda items: items]))
+
+def test_batched_keeps_order_and_sizes():
+    assert list(batched(iter(range(7)), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(batched([], 3)) == []
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_imap_bounded_keeps_input_order(max_workers):
+    def slow_square(item):
+        # Later items finish first
+        time.sleep((10 - item) * 0.002)
+        return item * item
+
+    assert list(imap_bounded(slow_square, iter(range(10)), max_workers)) == [item * item for item in range(10)]
+
+def test_imap_bounded_runs_at_most_max_workers_calls_at_once():
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def track(item):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.005)
+        with lock:
+            running -= 1
+        return item
+
+    assert list(imap_bounded(track, range(20), 3)) == list(range(20))
+    assert peak <= 3
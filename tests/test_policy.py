@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from config import CPU_POLICY_IDLE_HOURS
+from policy import SAMPLES_PER_HOUR, load_series, longest_idle_run, evaluate_matrix, evaluate_policy
+
+IDLE_RUN = CPU_POLICY_IDLE_HOURS * SAMPLES_PER_HOUR
+
+def test_longest_idle_run_is_split_by_a_busy_sample():
+    idle = np.array([[True, True, False, True, True, True],
+                     [True, True, True, True, True, True],
+                     [False, False, False, False, False, False]])
+
+    assert longest_idle_run(idle).tolist() == [3, 6, 0]
+
+def test_longest_idle_run_of_an_empty_matrix():
+    assert longest_idle_run(np.zeros((2, 0), dtype=bool)).tolist() == [0, 0]
+
+def test_load_series_pads_short_rows_with_nan():
+    matrix = load_series([[1.0, 2.0, 3.0], [4.0], []])
+
+    assert matrix.shape == (3, 3)
+    assert matrix[0].tolist() == [1.0, 2.0, 3.0]
+    assert matrix[1, 0] == 4.0
+    assert np.isnan(matrix[1, 1:]).all() and np.isnan(matrix[2]).all()
+
+def test_nan_padding_does_not_extend_an_idle_run():
+    # The short series ends idle, its padding must not count as idle samples
+    series = {"short": [50.0] + [1.0] * (IDLE_RUN - 1), "long": [1.0] * IDLE_RUN + [50.0] * 10}
+
+    assert evaluate_policy(series, 5.0, "idle_hours") == {"short": False, "long": True}
+
+def test_idle_run_split_by_one_busy_sample_is_not_idle():
+    half = IDLE_RUN // 2
+    series = {"split": [1.0] * half + [50.0] + [1.0] * half}
+
+    assert evaluate_policy(series, 5.0, "idle_hours") == {"split": False}
+
+@pytest.mark.parametrize("policy", ["max", "percentile", "idle_hours", "idle_share"])
+def test_rows_without_data_are_idle(policy):
+    matrix = np.array([[np.nan, np.nan], [50.0, 50.0]], dtype=np.float32)
+
+    assert evaluate_matrix(matrix, 5.0, policy).tolist() == [True, False]
+    assert evaluate_policy({"empty": []}, 5.0, policy) == {"empty": True}
+
+def test_max_policy_threshold_is_inclusive():
+    assert evaluate_policy({"at": [1.0, 5.0], "above": [1.0, 5.5]}, 5.0, "max") == {"at": True, "above": False}
+
+def test_percentile_policy_threshold_boundary():
+    # The 95th percentile of 0..20 is exactly 19
+    series = {"vm": [float(value) for value in range(21)]}
+
+    assert evaluate_policy(series, 19.0, "percentile") == {"vm": True}
+    assert evaluate_policy(series, 18.5, "percentile") == {"vm": False}
+
+def test_idle_share_policy_threshold_boundary():
+    # 19 of 20 samples below the threshold is exactly the default 0.95 share
+    series = {"at": [1.0] * 19 + [50.0], "below": [1.0] * 18 + [50.0] * 2}
+
+    assert evaluate_policy(series, 5.0, "idle_share") == {"at": True, "below": False}
+
+def test_idle_share_ignores_nan_padding():
+    series = {"short": [1.0] * 19 + [50.0], "long": [1.0] * 40}
+
+    assert evaluate_policy(series, 5.0, "idle_share") == {"short": True, "long": True}
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        evaluate_policy({"vm": [1.0]}, 5.0, "median")
@@ -0,0 +1,86 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http import HTTPStatus
+from types import SimpleNamespace
+
+from config import RATE_LIMIT_INCREASE_AFTER
+from ratelimit import AdaptiveLimiter, classify_error, parse_retry_after
+
+class BotocoreError(Exception):
+    def __init__(self, code, headers=None):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPHeaders': headers or {}}}
+
+class ApiCoreError(Exception):
+    def __init__(self, code, grpc_status_code=None):
+        super().__init__(code)
+        self.code = code
+        self.grpc_status_code = grpc_status_code
+
+class AzureError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+def test_classify_botocore_errors():
+    assert classify_error(BotocoreError('ThrottlingException', {'retry-after': '3'})) == (True, 3.0)
+    assert classify_error(BotocoreError('RequestLimitExceeded')) == (True, None)
+    assert classify_error(BotocoreError('AccessDenied')) == (False, None)
+
+def test_classify_api_core_errors():
+    assert classify_error(ApiCoreError(HTTPStatus.TOO_MANY_REQUESTS)) == (True, None)
+    assert classify_error(ApiCoreError(None, SimpleNamespace(name='RESOURCE_EXHAUSTED'))) == (True, None)
+    assert classify_error(ApiCoreError(HTTPStatus.NOT_FOUND, SimpleNamespace(name='NOT_FOUND'))) == (False, None)
+
+def test_classify_azure_errors():
+    assert classify_error(AzureError(429, {'Retry-After': '7'})) == (True, 7.0)
+    assert classify_error(AzureError(429)) == (True, None)
+    assert classify_error(AzureError(404)) == (False, None)
+
+def test_classify_other_errors():
+    assert classify_error(ValueError("boom")) == (False, None)
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after("12") == 12.0
+    assert parse_retry_after("-1") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+
+def test_parse_retry_after_http_date():
+    value = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+
+    assert 25 <= parse_retry_after(value) <= 30
+    past = format_datetime(datetime.now(timezone.utc) - timedelta(seconds=30), usegmt=True)
+    assert parse_retry_after(past) == 0.0
+
+def test_limit_halves_on_throttle_and_rises_after_successes():
+    limiter = AdaptiveLimiter(1000, max_concurrency=8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+
+    for _ in range(RATE_LIMIT_INCREASE_AFTER - 1):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 4
+    limiter.acquire()
+    limiter.release()
+    assert limiter.limit == 5
+
+def test_limit_never_drops_below_one():
+    limiter = AdaptiveLimiter(1000, max_concurrency=2)
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release(throttled=True)
+
+    assert limiter.limit == 1
+
+def test_limiter_below_one_request_per_second_starts_a_request():
+    limiter = AdaptiveLimiter(0.5)
+    thread = threading.Thread(target=limiter.acquire, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
@@ -1,68 +1,185 @@
 import logging
-from config import REQUIRED_TAGS
-from auth import get_aws_client, get_gcp_client, get_azure_client
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import REQUIRED_TAGS, DELETE_TIMEOUT_SECONDS, DELETE_POLL_INTERVAL_SECONDS
+from ratelimit import call_api
+from telemetry import telemetry
+from inventory import describe_vm
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-def check_required_tags(client, *args):
-    resource_id = args[0]
-    logger.info(f"Checking required tags for resource: {resource_id}")
+# TerminateInstances accepts up to 1000 instance IDs per call
+AWS_TERMINATE_BATCH_SIZE = 1000
+
+def summarize_results(results):
+    summary = {k: {"success": 0, "failed": 0, "total": 0} for k in results}
+    for cloud, vms in results.items():
+        for vm_id, success, msg in vms:
+            summary[cloud]["total"] += 1
+            summary[cloud]["success" if success else "failed"] += 1
+    return summary
+
+def bounded_map(func, items, max_workers):
+    """Apply func to every item using at most max_workers threads, preserving order."""
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
+def tags_match(tags):
+    return bool(tags) and all(tags.get(k) == v for k, v in REQUIRED_TAGS.items())
+
+def check_required_tags(client, record):
+    """Check the tags of the VM described by record against REQUIRED_TAGS.
+
+    client is the provider's EC2, InstancesClient or ComputeManagementClient. The
+    creation time and location are filled in along with the tags (see
+    inventory.describe_vm), so a following age check needs no further call.
+    """
+    logger.debug(f"Checking required tags for resource: {record.id}")
     try:
-        # Add detailed logging to trace the flow
-        logger.info(f"Client: {client}, Resource ID: {resource_id}")
-        if hasattr(client, 'describe_instances'):  # AWS
-            instance_id = args[0]
-            ec2_client = get_aws_client('ec2')
-            response = ec2_client.describe_instances(InstanceIds=[instance_id])
-            tags = response['Reservations'][0]['Instances'][0].get('Tags', [])
-            tags_dict = {tag['Key']: tag['Value'] for tag in tags}
-            result = all(tags_dict.get(k) == v for k, v in REQUIRED_TAGS.items())
-        elif hasattr(client, 'get'):  # GCP
-            project_id, zone, instance_id = args
-            compute_client = get_gcp_client()
-            instance = compute_client.get(project=project_id, zone=zone, instance=instance_id)
-            labels = instance.labels
-            result = labels and all(labels.get(k) == v for k, v in REQUIRED_TAGS.items())
-        else:  # Azure
-            vm_resource_id = args[0]
-            compute_client = get_azure_client()
-            parts = vm_resource_id.split('/')
-            resource_group = parts[4]
-            vm_name = parts[8]
-            vm = compute_client.virtual_machines.get(resource_group, vm_name)
-            result = vm.tags and all(vm.tags.get(k) == v for k, v in REQUIRED_TAGS.items())
-        logger.info(f"Tags check completed for resource: {resource_id}")
+        describe_vm(client, record)
+        result = tags_match(record.tags)
+        logger.debug(f"Tags check completed for resource: {record.id}")
     except Exception as e:
         logger.error(f"Error in check_required_tags: {e}")
         raise
     return result
 
-def remove_vm(client, *args):
-    resource_id = args[0]
-    logger.info(f"Attempting to remove VM: {resource_id}")
-    try:
-        if hasattr(client, 'terminate_instances'):  # AWS
-            instance_id = args[0]
-            ec2_client = get_aws_client('ec2')
-            ec2_client.terminate_instances(InstanceIds=[instance_id])
-            result = True, f"AWS instance {instance_id} termination initiated"
-        elif hasattr(client, 'delete'):  # GCP
-            project_id, zone, instance_id = args
-            compute_client = get_gcp_client()
-            op = compute_client.delete(project=project_id, zone=zone, instance=instance_id)
-            op.result()
-            result = True, f"GCP instance {instance_id} deleted"
-        else:  # Azure
-            vm_resource_id = args[0]
-            compute_client = get_azure_client()
-            parts = vm_resource_id.split('/')
-            resource_group = parts[4]
-            vm_name = parts[8]
-            poller = compute_client.virtual_machines.begin_delete(resource_group, vm_name)
-            poller.result()
-            result = True, f"Azure VM {vm_name} deleted"
-    except Exception as e:
-        result = False, f"Failed to remove VM: {e}"
-    logger.info(f"VM {resource_id} removed successfully.")
-    return result
+def terminate_instances_aws(ec2_client, instance_ids):
+    """Terminate AWS instances in batches of AWS_TERMINATE_BATCH_SIZE.
+
+    A batch that fails as a whole (for example because one ID is invalid) is
+    retried one instance at a time, so one bad instance does not fail the others.
+    """
+    instance_ids = list(instance_ids)
+    results = []
+    with telemetry.span("aws", "delete"):
+        for offset in range(0, len(instance_ids), AWS_TERMINATE_BATCH_SIZE):
+            batch = instance_ids[offset:offset + AWS_TERMINATE_BATCH_SIZE]
+            logger.info(f"Terminating {len(batch)} AWS instances")
+            try:
+                call_api('aws', 'delete', ec2_client.terminate_instances, InstanceIds=batch)
+                results.extend((instance_id, True, f"AWS instance {instance_id} termination initiated")
+                               for instance_id in batch)
+            except Exception as e:
+                logger.error(f"Batch termination failed, retrying instances one by one: {e}")
+                for instance_id in batch:
+                    try:
+                        call_api('aws', 'delete', ec2_client.terminate_instances, InstanceIds=[instance_id])
+                        results.append((instance_id, True, f"AWS instance {instance_id} termination initiated"))
+                    except Exception as e:
+                        results.append((instance_id, False, f"Failed to remove VM: {e}"))
+    return results
+
+class DeletionTracker:
+    """Tracks long-running GCP and Azure delete operations without blocking on each one.
+
+    submit() starts a delete and keeps the returned operation (a GCP
+    ExtendedOperation or an Azure LROPoller). wait() then polls every pending
+    operation until all are done or the shared timeout expires, and returns one
+    (id, success, message) tuple per submitted VM, in submission order. Polls go
+    through the 'operations' rate limiter of provider.
+    """
+
+    def __init__(self, provider, timeout=DELETE_TIMEOUT_SECONDS, poll_interval=DELETE_POLL_INTERVAL_SECONDS):
+        self.provider = provider
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def submit(self, vm_id, begin, message):
+        """Call begin() to start the delete; message is reported once it completes.
+
+        Returns the operation, or None when the delete could not be started.
+        """
+        try:
+            with telemetry.span(self.provider, "delete"):
+                operation = begin()
+            entry = {'id': vm_id, 'operation': operation, 'message': message, 'result': None}
+        except Exception as e:
+            operation = None
+            entry = {'id': vm_id, 'operation': None, 'message': message,
+                     'result': (vm_id, False, f"Failed to remove VM: {e}")}
+        with self._lock:
+            self._entries.append(entry)
+        return operation
+
+    def attach(self, vm_id, operation, message):
+        """Track a delete operation that was started earlier, for example by an interrupted run."""
+        self.submit(vm_id, lambda: operation, message)
+
+    def wait(self):
+        with telemetry.span(self.provider, "delete"):
+            return self._wait()
+
+    def _wait(self):
+        deadline = time.monotonic() + self.timeout
+        pending = [entry for entry in self._entries if entry['result'] is None]
+        logger.info(f"Waiting for {len(pending)} delete operations to complete")
+        while pending:
+            still_pending = []
+            for entry in pending:
+                try:
+                    if not call_api(self.provider, 'operations', entry['operation'].done):
+                        still_pending.append(entry)
+                        continue
+                    # result() raises if the operation failed
+                    entry['operation'].result()
+                    entry['result'] = (entry['id'], True, entry['message'])
+                except Exception as e:
+                    entry['result'] = (entry['id'], False, f"Failed to remove VM: {e}")
+            pending = still_pending
+            if pending and time.monotonic() >= deadline:
+                for entry in pending:
+                    entry['result'] = (entry['id'], False,
+                                       f"Timed out after {self.timeout}s waiting for VM {entry['id']} to be deleted")
+                break
+            if pending:
+                time.sleep(self.poll_interval)
+        logger.info("Delete operations completed")
+        return [entry['result'] for entry in self._entries]
+
+def begin_remove_gcp(compute_client, instance):
+    """Start deleting a GCP instance and return the operation without waiting."""
+    return call_api('gcp', 'delete', compute_client.delete, project=instance.project, zone=instance.location,
+                    instance=instance.name)
+
+def begin_remove_azure(compute_client, vm, continuation_token=None):
+    """Start deleting an Azure VM and return the poller without waiting.
+
+    With a continuation_token from an earlier poller, the poller of that delete is
+    rebuilt instead and no new delete is sent.
+    """
+    if continuation_token:
+        return call_api('azure', 'delete', compute_client.virtual_machines.begin_delete, vm.resource_group, vm.name,
+                        continuation_token=continuation_token)
+    return call_api('azure', 'delete', compute_client.virtual_machines.begin_delete, vm.resource_group, vm.name)
+
+class GcpZoneOperation:
+    """done()/result() view of a GCP zone operation known only by its name.
+
+    Used to track deletes started by an earlier, interrupted run; each done()
+    call fetches the operation once.
+    """
+
+    def __init__(self, operations_client, project_id, zone, name):
+        self.operations_client = operations_client
+        self.project_id = project_id
+        self.zone = zone
+        self.name = name
+        self._operation = None
+
+    def done(self):
+        self._operation = self.operations_client.get(project=self.project_id, zone=self.zone, operation=self.name)
+        return self._operation.status == type(self._operation).Status.DONE
+
+    def result(self):
+        error = self._operation.error if self._operation else None
+        if error and error.errors:
+            raise RuntimeError(f"Operation {self.name} failed: {error.errors[0].message}")
+        return self._operation